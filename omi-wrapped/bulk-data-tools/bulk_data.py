@@ -0,0 +1,381 @@
+"""
+Bulk export / backfill for the Omi Wrapped Firestore collections.
+
+Export streams documents in pages (bounded memory) to JSONL or Parquet:
+    python bulk_data.py export --collection raw_memories --out raw.jsonl
+    python bulk_data.py export --collection daily_reflections --uid ckVQW3MVAoenlOdYhHLt5K3zPpW2 --out refl.parquet
+
+Import bulk-loads an export back with parallel batched writers, checkpointing as it goes.
+Re-running the same command resumes after the last fully committed chunk:
+    python bulk_data.py import --collection raw_memories --in raw.jsonl --workers 8
+
+Both commands write a checkpoint file (<output/input>.checkpoint.json by default). Re-running an
+export whose checkpoint is marked completed starts a fresh export.
+"""
+import os
+import sys
+import json
+import base64
+import logging
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+COLLECTIONS = ["raw_memories", "daily_reflections"]
+# Firestore caps a WriteBatch at 500 operations and a commit request at 10 MiB. A raw_memories
+# day holds full transcripts, so batches are also cut by (estimated) size, with some headroom
+MAX_BATCH_SIZE = 500
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 500
+
+
+# --- Value Encoding ---
+# Firestore Timestamps and bytes don't survive JSON, so they are tagged and restored on import.
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return {"__timestamp__": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, dict):
+        return {k: encode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [encode_value(v) for v in value]
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and "__timestamp__" in value:
+            return datetime.fromisoformat(value["__timestamp__"])
+        if len(value) == 1 and "__bytes__" in value:
+            return base64.b64decode(value["__bytes__"])
+        return {k: decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    return value
+
+
+# --- Checkpoints ---
+
+def load_checkpoint(path: str) -> dict:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(path: str, state: dict):
+    # Write-then-rename so an interrupted run never leaves a truncated checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+# --- Writers / Readers (JSONL and Parquet) ---
+
+class JsonlWriter:
+    def __init__(self, path: str, append: bool):
+        self.f = open(path, "a" if append else "w", encoding="utf-8")
+
+    def write_chunk(self, rows: list):
+        for doc_id, data in rows:
+            self.f.write(json.dumps({"id": doc_id, "data": encode_value(data)}, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    """One row group per chunk. Documents are stored as (id, JSON data) so nested
+    memory arrays don't need a fixed Parquet schema."""
+
+    def __init__(self, path: str, append: bool):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Parquet support needs pyarrow: pip install pyarrow")
+        if append:
+            # Parquet files can't be appended to; resume writes a numbered part file alongside
+            base, ext = os.path.splitext(path)
+            part = 1
+            while os.path.exists(f"{base}.part{part}{ext}"):
+                part += 1
+            path = f"{base}.part{part}{ext}"
+            logging.info(f"Resuming Parquet export into new part file {path}")
+        self.pa = pa
+        self.schema = pa.schema([("id", pa.string()), ("data", pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write_chunk(self, rows: list):
+        table = self.pa.Table.from_pydict(
+            {"id": [r[0] for r in rows], "data": [json.dumps(encode_value(r[1]), ensure_ascii=False) for r in rows]},
+            schema=self.schema,
+        )
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+def is_parquet(path: str) -> bool:
+    return path.endswith(".parquet")
+
+
+def iter_input_chunks(path: str, chunk_size: int):
+    """Yields lists of (doc_id, data) of up to chunk_size rows, reading the file incrementally."""
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=["id", "data"]):
+            ids, datas = batch.column(0).to_pylist(), batch.column(1).to_pylist()
+            yield [(doc_id, decode_value(json.loads(data))) for doc_id, data in zip(ids, datas)]
+        return
+
+    chunk = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            chunk.append((row["id"], decode_value(row["data"])))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- Cold Storage ---
+# raw_memories days older than the retention window keep their transcripts in a zstd blob
+# (see daily-reflection-processor/cold_storage.py). Exports decompress them back into each
+# memory so archives are plain, self-contained documents that import as hot documents.
+COLD_STORAGE_FIELDS = ("transcripts_zstd", "transcripts_dict_id", "storage_tier", "compacted_at")
+_dictionaries = {}
+
+
+def hydrate_cold_document(client, data: dict) -> dict:
+    if data.get("storage_tier") != "cold" or not data.get("transcripts_zstd"):
+        return data
+    import zstandard # Only needed once a cold document shows up
+
+    dict_id = data.get("transcripts_dict_id")
+    if dict_id and dict_id not in _dictionaries:
+        snapshot = client.collection("retention_dictionaries").document(dict_id).get()
+        _dictionaries[dict_id] = zstandard.ZstdCompressionDict(snapshot.to_dict()["dictionary"])
+    dictionary = _dictionaries.get(dict_id)
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary) if dictionary else zstandard.ZstdDecompressor()
+    transcripts = json.loads(decompressor.decompress(data["transcripts_zstd"]))
+    memories = data.get("memories", [])
+    if isinstance(transcripts, dict):
+        # Older blobs are keyed by memory_id, newer ones are a list by position in memories
+        transcripts = [transcripts.get(m.get("memory_id")) for m in memories]
+
+    hydrated = {k: v for k, v in data.items() if k not in COLD_STORAGE_FIELDS}
+    hydrated["memories"] = [
+        {**m, "transcript": transcripts[i]} if "transcript" not in m and i < len(transcripts) and transcripts[i] else m
+        for i, m in enumerate(memories)
+    ]
+    # Imported back as a hot document, so let compaction pick it up again
+    hydrated["compaction_pending"] = True
+    return hydrated
+
+
+# --- Export ---
+
+def iter_collection_pages(client, collection: str, page_size: int, start_after_id: str | None, uid: str | None):
+    """Pages through a collection ordered by document ID, so memory stays bounded and
+    the export can resume from the last exported ID."""
+    coll = client.collection(collection)
+    query = coll.order_by(FieldPath.document_id())
+    if uid:
+        # Document IDs are {uid}_{YYYY-MM-DD}, so a user's docs form a contiguous ID range
+        query = query.where(FieldPath.document_id(), ">=", coll.document(f"{uid}_"))
+        query = query.where(FieldPath.document_id(), "<", coll.document(f"{uid}_\uf8ff"))
+
+    last_id = start_after_id
+    while True:
+        page_query = query.limit(page_size)
+        if last_id:
+            page_query = page_query.start_after({FieldPath.document_id(): coll.document(last_id)})
+        page = [(snap.id, snap.to_dict() or {}) for snap in page_query.stream()]
+        if not page:
+            return
+        yield page
+        last_id = page[-1][0]
+
+
+def run_export(args):
+    client = firestore.Client()
+    checkpoint_path = args.checkpoint or f"{args.out}.checkpoint.json"
+    state = load_checkpoint(checkpoint_path) if args.resume else {}
+    if state and (state.get("collection") != args.collection or state.get("uid") != args.uid):
+        sys.exit(f"Checkpoint {checkpoint_path} belongs to collection {state.get('collection')}, uid {state.get('uid') or 'all'}")
+    if state.get("completed"):
+        # Resuming past the last ID of a finished export would write nothing, so re-export instead
+        logging.info(f"Checkpoint {checkpoint_path} is from a completed export, starting over")
+        state = {}
+
+    resuming = bool(state.get("last_id"))
+    writer = (ParquetWriter if is_parquet(args.out) else JsonlWriter)(args.out, append=resuming)
+    exported = state.get("exported", 0)
+    if resuming:
+        logging.info(f"Resuming export of {args.collection} after {state['last_id']} ({exported} docs already exported)")
+
+    try:
+        for page in iter_collection_pages(client, args.collection, args.chunk_size, state.get("last_id"), args.uid):
+            if args.collection == "raw_memories" and not args.keep_compressed:
+                page = [(doc_id, hydrate_cold_document(client, data)) for doc_id, data in page]
+            writer.write_chunk(page)
+            exported += len(page)
+            save_checkpoint(checkpoint_path, {
+                "collection": args.collection, "uid": args.uid, "last_id": page[-1][0], "exported": exported,
+            })
+            logging.info(f"Exported {exported} documents (last: {page[-1][0]})")
+    finally:
+        writer.close()
+
+    save_checkpoint(checkpoint_path, {"collection": args.collection, "uid": args.uid, "exported": exported, "completed": True})
+
+    logging.info(f"Export complete: {exported} documents from {args.collection} to {args.out}")
+
+
+# --- Import ---
+
+def estimate_document_bytes(doc_id: str, data: dict) -> int:
+    """Rough request size of one write: the encoded document plus its ID and some per-write overhead."""
+    return len(json.dumps(encode_value(data), ensure_ascii=False).encode("utf-8")) + len(doc_id) + 64
+
+
+def iter_write_batches(rows: list):
+    """Splits rows into groups that fit one WriteBatch: <= MAX_BATCH_SIZE writes and <= MAX_BATCH_BYTES.
+    A single document over the byte limit still goes alone (Firestore rejects it with a clear error)."""
+    group, group_bytes = [], 0
+    for doc_id, data in rows:
+        size = estimate_document_bytes(doc_id, data)
+        if group and (len(group) >= MAX_BATCH_SIZE or group_bytes + size > MAX_BATCH_BYTES):
+            yield group
+            group, group_bytes = [], 0
+        group.append((doc_id, data))
+        group_bytes += size
+    if group:
+        yield group
+
+
+def with_compaction_fields(doc_id: str, data: dict) -> dict:
+    """raw_memories documents need `date` and `compaction_pending` for cold-storage compaction to
+    find them (it only queries pending days). Archives made before those fields existed lack them."""
+    if "date" in data and "compaction_pending" in data:
+        return data
+    stamped = dict(data)
+    stamped.setdefault("date", doc_id.rsplit("_", 1)[-1])
+    stamped.setdefault("compaction_pending", stamped.get("storage_tier") != "cold")
+    return stamped
+
+
+def commit_chunk(client, collection: str, rows: list, merge: bool):
+    """Commits one chunk as one or more WriteBatches, split by operation count and request size."""
+    coll = client.collection(collection)
+    for group in iter_write_batches(rows):
+        batch = client.batch()
+        for doc_id, data in group:
+            if collection == "raw_memories":
+                data = with_compaction_fields(doc_id, data)
+            batch.set(coll.document(doc_id), data, merge=merge)
+        batch.commit()
+    return len(rows)
+
+
+def run_import(args):
+    client = firestore.Client()
+    checkpoint_path = args.checkpoint or f"{args.input}.checkpoint.json"
+    state = load_checkpoint(checkpoint_path) if args.resume else {}
+    if state and (state.get("collection") != args.collection or state.get("chunk_size") != args.chunk_size):
+        sys.exit(f"Checkpoint {checkpoint_path} was written for a different collection/chunk size")
+
+    # Chunks [0, next_chunk) are durably committed. Completed chunks beyond that (finished out of
+    # order by parallel workers) are tracked in `done` until the gap closes.
+    next_chunk = state.get("next_chunk", 0)
+    imported = state.get("imported", 0)
+    done = set()
+    lock = threading.Lock()
+    if next_chunk:
+        logging.info(f"Resuming import into {args.collection} at chunk {next_chunk} ({imported} docs already imported)")
+
+    def on_done(chunk_index: int, count: int):
+        nonlocal next_chunk, imported
+        with lock:
+            done.add(chunk_index)
+            imported += count
+            while next_chunk in done:
+                done.remove(next_chunk)
+                next_chunk += 1
+            save_checkpoint(checkpoint_path, {
+                "collection": args.collection, "chunk_size": args.chunk_size,
+                "next_chunk": next_chunk, "imported": imported,
+            })
+
+    # Bound the number of chunks held in memory to a couple per worker
+    max_pending = args.workers * 2
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = {}
+        for chunk_index, rows in enumerate(iter_input_chunks(args.input, args.chunk_size)):
+            if chunk_index < next_chunk:
+                continue
+            if len(pending) >= max_pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    on_done(pending.pop(future), future.result())
+            pending[pool.submit(commit_chunk, client, args.collection, rows, args.merge)] = chunk_index
+            if chunk_index % 20 == 0:
+                logging.info(f"Submitted chunk {chunk_index} ({imported} docs committed so far)")
+        for future in list(pending):
+            on_done(pending.pop(future), future.result())
+
+    logging.info(f"Import complete: {imported} documents into {args.collection}")
+
+
+# --- CLI ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk export/backfill for Omi Wrapped Firestore collections.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_p = sub.add_parser("export", help="Stream a collection out to JSONL or Parquet")
+    export_p.add_argument("--collection", choices=COLLECTIONS, required=True)
+    export_p.add_argument("--out", required=True, help="Output path (.jsonl or .parquet)")
+    export_p.add_argument("--uid", help="Only export documents for this user")
+    export_p.add_argument("--keep-compressed", action="store_true", help="Export cold raw_memories as stored (zstd blobs) instead of decompressing")
+    export_p.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Documents per page/row group")
+
+    import_p = sub.add_parser("import", help="Bulk-load a JSONL or Parquet export into a collection")
+    import_p.add_argument("--collection", choices=COLLECTIONS, required=True)
+    import_p.add_argument("--in", dest="input", required=True, help="Input path (.jsonl or .parquet)")
+    import_p.add_argument("--workers", type=int, default=8, help="Parallel batch writers")
+    import_p.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Documents per batch commit")
+    import_p.add_argument("--merge", action="store_true", help="Merge into existing documents instead of overwriting")
+
+    for p in (export_p, import_p):
+        p.add_argument("--checkpoint", help="Checkpoint file (default: <path>.checkpoint.json)")
+        p.add_argument("--no-resume", dest="resume", action="store_false", help="Ignore any existing checkpoint")
+
+    args = parser.parse_args()
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+
+    if args.command == "export":
+        run_export(args)
+    else:
+        run_import(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import re
+import uuid
+import random
+import hashlib
+import logging
+from google.cloud import firestore
+
+# --- Cross-Day Action-Item Tracker ---
+# action_items are generated independently per day, so the same task mentioned on five days
+# shows up five times. After each reflection write we fold the day's items into a per-user store:
+#   action_items/{uid}/items/{item_id}        -> {text, status, dates[], first_seen, last_seen, ...}
+#   action_items/{uid}/lsh_buckets/{band_key} -> {item_ids[]}
+#   action_items/{uid}/days/{date}            -> {item_ids[]} the day's reflection produced
+# Near-duplicates are found with MinHash + LSH banding: an item's signature is split into
+# LSH_BANDS bands, and only items sharing at least one band bucket are compared. Each lookup
+# reads a fixed number of bucket documents, no matter how long the user's history is.
+
+ROOT_COLLECTION = "action_items"
+ITEMS_SUBCOLLECTION = "items"
+BUCKETS_SUBCOLLECTION = "lsh_buckets"
+DAYS_SUBCOLLECTION = "days"
+NUM_PERM = 64
+LSH_BANDS = 16 # 16 bands x 4 rows -> candidates from ~0.5 Jaccard similarity up
+LSH_ROWS = NUM_PERM // LSH_BANDS
+MERGE_THRESHOLD = 0.6 # Estimated Jaccard needed to treat two items as the same task
+SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed: signatures must be identical across processes and deploys
+_rng = random.Random(1337)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+_STOPWORDS = {"the", "a", "an", "to", "for", "of", "and", "with", "on", "in", "about", "by", "my", "your"}
+
+
+def normalize_item(text: str) -> str:
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    return " ".join(w for w in words if w not in _STOPWORDS)
+
+
+def _shingles(normalized: str) -> set:
+    # Character shingles are robust to small wording changes ("send minutes" / "send the minutes")
+    padded = f" {normalized} "
+    if len(padded) <= SHINGLE_SIZE:
+        return {padded}
+    return {padded[i:i + SHINGLE_SIZE] for i in range(len(padded) - SHINGLE_SIZE + 1)}
+
+
+def _hash64(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash_signature(normalized: str) -> list:
+    hashes = [_hash64(s) for s in _shingles(normalized)]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def estimated_similarity(sig_a: list, sig_b: list) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+
+def band_keys(signature: list) -> list:
+    keys = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode("ascii"), digest_size=8).hexdigest()
+        keys.append(f"{band}_{digest}")
+    return keys
+
+
+def _find_duplicate(transaction, user_ref, signature: list, keys: list):
+    """Returns (item_snapshot, similarity) of the best matching existing item, or (None, 0).
+    Reading the band buckets inside the transaction means two concurrent writers of similar
+    items contend on the same bucket documents, and the loser retries and sees the winner's item."""
+    buckets = transaction.get_all([user_ref.collection(BUCKETS_SUBCOLLECTION).document(k) for k in keys])
+    candidate_ids = set()
+    for bucket in buckets:
+        if bucket.exists:
+            candidate_ids.update((bucket.to_dict() or {}).get("item_ids", []))
+    if not candidate_ids:
+        return None, 0.0
+
+    best, best_similarity = None, 0.0
+    items = transaction.get_all([user_ref.collection(ITEMS_SUBCOLLECTION).document(i) for i in candidate_ids])
+    for item in items:
+        if not item.exists:
+            continue
+        similarity = estimated_similarity(signature, item.to_dict().get("signature", []))
+        if similarity > best_similarity:
+            best, best_similarity = item, similarity
+    return (best, best_similarity) if best_similarity >= MERGE_THRESHOLD else (None, best_similarity)
+
+
+def _date_fields(dates: set) -> dict:
+    return {"dates": sorted(dates), "occurrences": len(dates), "first_seen": min(dates), "last_seen": max(dates)}
+
+
+@firestore.transactional
+def _upsert_item(transaction, user_ref, text: str, normalized: str, date_str: str, source_doc_id: str):
+    """Merges one item into its near-duplicate, or creates it. Returns (item_id, merged)."""
+    signature = minhash_signature(normalized)
+    keys = band_keys(signature)
+    existing, similarity = _find_duplicate(transaction, user_ref, signature, keys)
+
+    if existing is not None:
+        item = existing.to_dict()
+        update = {
+            **_date_fields(set(item.get("dates", [])) | {date_str}),
+            "source_doc_ids": firestore.ArrayUnion([source_doc_id]),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+        # Mentioned again after being marked done -> it's back on the list
+        if item.get("status") == "done" and date_str > (item.get("done_on") or ""):
+            update["status"] = "open"
+        if date_str >= item.get("last_seen", ""):
+            update["text"] = text # Keep the most recent wording
+        transaction.update(existing.reference, update)
+        logging.info(f"Merged action item into {existing.id} (similarity {similarity:.2f}): {text}")
+        return existing.id, True
+
+    item_ref = user_ref.collection(ITEMS_SUBCOLLECTION).document(uuid.uuid4().hex)
+    transaction.set(item_ref, {
+        "text": text,
+        "normalized": normalized,
+        "signature": signature,
+        "status": "open",
+        **_date_fields({date_str}),
+        "source_doc_ids": [source_doc_id],
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    })
+    for key in keys:
+        transaction.set(user_ref.collection(BUCKETS_SUBCOLLECTION).document(key),
+                        {"item_ids": firestore.ArrayUnion([item_ref.id])}, merge=True)
+    return item_ref.id, False
+
+
+@firestore.transactional
+def _retract_date(transaction, user_ref, item_id: str, date_str: str, source_doc_id: str) -> bool:
+    """Removes a day's mention from an item (the day was regenerated without it). An item left
+    with no mentions is deleted along with its bucket entries. Returns True if it was deleted."""
+    item_ref = user_ref.collection(ITEMS_SUBCOLLECTION).document(item_id)
+    snapshot = item_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    item = snapshot.to_dict()
+    dates = set(item.get("dates", [])) - {date_str}
+    if dates:
+        transaction.update(item_ref, {
+            **_date_fields(dates),
+            "source_doc_ids": firestore.ArrayRemove([source_doc_id]),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+        return False
+    transaction.delete(item_ref)
+    for key in band_keys(item.get("signature", [])):
+        transaction.set(user_ref.collection(BUCKETS_SUBCOLLECTION).document(key),
+                        {"item_ids": firestore.ArrayRemove([item_id])}, merge=True)
+    return True
+
+
+def record_action_items(firestore_client, user_id: str, date_str: str, action_items: list) -> dict:
+    """
+    Folds one day's action items into the user's store, one transaction per item. Idempotent per
+    (item, date): occurrences are tracked as a set of dates. The item IDs a day produced are kept
+    in days/{date}, so regenerating the day retracts the mentions it no longer produces.
+    """
+    user_ref = firestore_client.collection(ROOT_COLLECTION).document(user_id)
+    day_ref = user_ref.collection(DAYS_SUBCOLLECTION).document(date_str)
+    source_doc_id = f"{user_id}_{date_str}"
+    summary = {"merged": 0, "created": 0, "retracted": 0, "deleted": 0}
+
+    item_ids = []
+    for text in action_items:
+        if not isinstance(text, str) or not text.strip():
+            continue
+        normalized = normalize_item(text)
+        if not normalized:
+            continue
+        item_id, merged = _upsert_item(firestore_client.transaction(), user_ref, text.strip(), normalized, date_str, source_doc_id)
+        if item_id not in item_ids:
+            item_ids.append(item_id)
+        summary["merged" if merged else "created"] += 1
+
+    day_snapshot = day_ref.get()
+    previous_ids = (day_snapshot.to_dict() or {}).get("item_ids", []) if day_snapshot.exists else []
+    for item_id in previous_ids:
+        if item_id in item_ids:
+            continue
+        deleted = _retract_date(firestore_client.transaction(), user_ref, item_id, date_str, source_doc_id)
+        summary["deleted" if deleted else "retracted"] += 1
+    day_ref.set({"item_ids": item_ids, "updated_at": firestore.SERVER_TIMESTAMP})
+
+    return summary
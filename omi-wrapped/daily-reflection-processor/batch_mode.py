@@ -0,0 +1,133 @@
+import os
+import json
+import logging
+import tempfile
+import httpx
+import openai
+
+# --- Batch-File Mode for Nightly Reflections ---
+# Non-urgent user-days don't need an interactive chat completion each. Instead every pending
+# prompt is rendered into one JSONL batch file, submitted to the provider's Batch API, polled
+# until complete, and the results are fanned back into daily_reflections.
+# The endpoint is pluggable: BATCH_API_BASE_URL points the backend at any OpenAI-compatible
+# Batch API (e.g. a local stand-in server in tests) instead of api.openai.com.
+
+BATCH_JOBS_COLLECTION = "batch_jobs"
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_API_BASE_URL = os.environ.get("BATCH_API_BASE_URL") # None -> the real OpenAI API
+BATCH_API_KEY = os.environ.get("BATCH_API_KEY") or os.environ.get("OPENAI_API_KEY")
+
+# Provider batch statuses
+TERMINAL_SUCCESS = {"completed"}
+TERMINAL_FAILURE = {"failed", "expired", "cancelled"}
+# OpenAI caps batch input files at 200 MB; stay below it
+BATCH_MAX_FILE_BYTES = int(os.environ.get("BATCH_MAX_FILE_BYTES", str(180 * 1024 * 1024)))
+
+
+class OpenAIBatchBackend:
+    """Batch API backend for OpenAI, or anything speaking the same protocol at base_url."""
+
+    def __init__(self, api_key: str, base_url: str | None = None):
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=httpx.Client())
+
+    def submit(self, jsonl_path: str, metadata: dict | None = None) -> str:
+        """Uploads the batch file and creates the batch. Returns the provider batch ID."""
+        with open(jsonl_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+            metadata=metadata,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> dict:
+        batch = self.client.batches.retrieve(batch_id)
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+        }
+
+    def download(self, file_id: str) -> str:
+        return self.client.files.content(file_id).text
+
+
+def get_batch_backend():
+    """Returns the configured batch backend (None if no API key is available)."""
+    if not BATCH_API_KEY:
+        logging.error("No BATCH_API_KEY/OPENAI_API_KEY set, batch mode unavailable.")
+        return None
+    if BATCH_API_BASE_URL:
+        logging.info(f"Using batch endpoint {BATCH_API_BASE_URL}")
+    return OpenAIBatchBackend(BATCH_API_KEY, BATCH_API_BASE_URL)
+
+
+def custom_id_for(user_id: str, date_str: str) -> str:
+    # Same shape as the Firestore document IDs, so results map straight back to {uid}_{date}
+    return f"{user_id}_{date_str}"
+
+
+class BatchFileWriter:
+    """
+    Streams Batch API JSONL lines to a temp file as they are rendered, so a large batch never
+    sits in memory. add() refuses a line that would push the file past max_bytes (the provider
+    caps input files), or past max_requests.
+    """
+
+    def __init__(self, max_requests: int, max_bytes: int):
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.bytes = 0
+        fd, self.path = tempfile.mkstemp(prefix="reflections_batch_", suffix=".jsonl")
+        self._file = os.fdopen(fd, "wb")
+
+    def full(self) -> bool:
+        return self.count >= self.max_requests
+
+    def add(self, custom_id: str, body: dict) -> bool:
+        line = (json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False) + "\n").encode("utf-8")
+        if self.full() or self.bytes + len(line) > self.max_bytes:
+            return False
+        self._file.write(line)
+        self.count += 1
+        self.bytes += len(line)
+        return True
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def parse_batch_output(text: str) -> dict:
+    """Maps custom_id -> message content (None for requests that errored)."""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            logging.error(f"Skipping unparseable batch output line: {line[:200]}")
+            continue
+        custom_id = row.get("custom_id")
+        if not custom_id:
+            continue
+        content = None
+        response = row.get("response") or {}
+        if not row.get("error") and response.get("status_code") == 200:
+            choices = (response.get("body") or {}).get("choices") or []
+            if choices:
+                content = ((choices[0].get("message") or {}).get("content") or "").strip() or None
+        if content is None:
+            logging.error(f"Batch request {custom_id} failed: {row.get('error') or response.get('status_code')}")
+        results[custom_id] = content
+    return results
@@ -0,0 +1,81 @@
+"""
+Benchmark transcript compaction on sample days.
+
+Usage:
+    # From Firestore (uses Application Default Credentials)
+    python benchmark_compaction.py --uid ckVQW3MVAoenlOdYhHLt5K3zPpW2 --start 2025-03-25 --end 2025-03-31
+
+    # From a local JSON file: a list of raw_memories documents ({"memories": [...]})
+    python benchmark_compaction.py --file sample_days.json --budget 3000
+"""
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+
+import transcript_compaction
+
+
+def load_days_from_file(path: str) -> list:
+    with open(path) as f:
+        docs = json.load(f)
+    if isinstance(docs, dict):
+        docs = [docs]
+    return [(doc.get("id", f"day_{i}"), doc.get("memories", [])) for i, doc in enumerate(docs)]
+
+
+def load_days_from_firestore(uid: str, start: str, end: str) -> list:
+    from google.cloud import firestore
+    import cold_storage # Old days keep their transcripts in a compressed blob
+    client = firestore.Client()
+    days = []
+    day = datetime.strptime(start, "%Y-%m-%d").date()
+    last = datetime.strptime(end, "%Y-%m-%d").date()
+    while day <= last:
+        doc_id = f"{uid}_{day.strftime('%Y-%m-%d')}"
+        snapshot = client.collection("raw_memories").document(doc_id).get()
+        if snapshot.exists:
+            days.append((doc_id, cold_storage.hydrate_memories(client, snapshot.to_dict() or {})))
+        day += timedelta(days=1)
+    return days
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report prompt tokens before/after transcript compaction.")
+    parser.add_argument("--file", help="Local JSON file of raw_memories documents")
+    parser.add_argument("--uid", help="User ID to read from Firestore")
+    parser.add_argument("--start", help="First date (YYYY-MM-DD) when reading from Firestore")
+    parser.add_argument("--end", help="Last date (YYYY-MM-DD) when reading from Firestore")
+    parser.add_argument("--budget", type=int, default=0, help="Token budget for extractive trimming (0 = off)")
+    args = parser.parse_args()
+
+    if args.file:
+        days = load_days_from_file(args.file)
+    elif args.uid and args.start and args.end:
+        days = load_days_from_firestore(args.uid, args.start, args.end)
+    else:
+        parser.error("Pass either --file or --uid/--start/--end")
+
+    total_before, total_after, total_ms = 0, 0, 0.0
+    print(f"{'day':<45} {'segs':>9} {'tokens':>15} {'saved':>7} {'ms':>7}")
+    for day_id, memories in days:
+        texts = [m.get("transcript", "") for m in memories if m.get("transcript")]
+        t0 = time.perf_counter()
+        _, stats = transcript_compaction.compact_transcripts(texts, args.budget)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+
+        before, after = stats["tokens_before"], stats["tokens_after"]
+        saved = (1 - after / before) * 100 if before else 0.0
+        print(f"{day_id:<45} {stats['segments_before']:>4}->{stats['segments_after']:<4} "
+              f"{before:>7}->{after:<7} {saved:>6.1f}% {elapsed_ms:>7.1f}")
+        total_before += before
+        total_after += after
+        total_ms += elapsed_ms
+
+    if total_before:
+        print(f"\nTotal prompt tokens (transcript only): {total_before} -> {total_after} "
+              f"({(1 - total_after / total_before) * 100:.1f}% saved), compaction time {total_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
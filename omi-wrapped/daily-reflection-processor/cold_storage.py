@@ -0,0 +1,223 @@
+import os
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+import zstandard
+from google.cloud import firestore
+
+# --- Tiered Retention: Compressed Cold Storage for Old raw_memories ---
+# Once a day is older than RETENTION_HOT_DAYS and its daily_reflections document exists, the
+# plaintext transcripts are only read occasionally (reprocessing, exports). The compaction job
+# moves them into one zstd blob per day, compressed with a dictionary trained on real
+# transcripts (small, similar documents compress far better with a shared dictionary):
+#   raw_memories/{uid}_{date}:
+#     memories[]            -> unchanged metadata, but without the `transcript` field
+#     transcripts_zstd      -> zstd(JSON [transcript | null, ...]), by position in memories[]
+#     transcripts_dict_id   -> retention_dictionaries/{id} used to compress it (None = no dictionary)
+#     storage_tier          -> "cold"
+# Readers call hydrate_memories(), which decompresses lazily (only when transcripts are needed).
+# Candidates are found without scanning history: the collector stamps every write with `date` and
+# compaction_pending=True, and compaction clears the flag, so each run reads only pending days.
+
+RETENTION_HOT_DAYS = int(os.environ.get("RETENTION_HOT_DAYS", "30"))
+RETENTION_MAX_DOCS_PER_RUN = int(os.environ.get("RETENTION_MAX_DOCS_PER_RUN", "500"))
+# Days without a reflection this long after the hot window are compacted anyway (nothing to wait for)
+NO_REFLECTION_GRACE_DAYS = int(os.environ.get("RETENTION_NO_REFLECTION_GRACE_DAYS", "7"))
+DICTIONARY_COLLECTION = "retention_dictionaries"
+DICTIONARY_SIZE_BYTES = 64 * 1024
+DICTIONARY_MAX_SAMPLES = 2000
+# Retrain the dictionary periodically so it tracks how people actually talk
+DICTIONARY_MAX_AGE_DAYS = int(os.environ.get("RETENTION_DICTIONARY_MAX_AGE_DAYS", "90"))
+COMPRESSION_LEVEL = 19 # Compaction is offline, decompression speed doesn't depend on the level
+COLD_TIER = "cold"
+SYSTEM_STATE_COLLECTION = "system_state"
+COLD_STORAGE_STATE_DOC = "cold_storage"
+
+_dictionary_cache = {} # dict_id -> zstandard.ZstdCompressionDict
+
+
+def _load_dictionary(firestore_client, dict_id: str):
+    if not dict_id:
+        return None
+    if dict_id not in _dictionary_cache:
+        snapshot = firestore_client.collection(DICTIONARY_COLLECTION).document(dict_id).get()
+        if not snapshot.exists:
+            raise ValueError(f"Compression dictionary {dict_id} not found")
+        _dictionary_cache[dict_id] = zstandard.ZstdCompressionDict(snapshot.to_dict()["dictionary"])
+    return _dictionary_cache[dict_id]
+
+
+def decompress_transcripts(firestore_client, blob: bytes, dict_id: str | None) -> dict:
+    dictionary = _load_dictionary(firestore_client, dict_id)
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary) if dictionary else zstandard.ZstdDecompressor()
+    return json.loads(decompressor.decompress(blob))
+
+
+def hydrate_memories(firestore_client, doc_data: dict) -> list:
+    """Returns the document's memories with transcripts, decompressing cold documents on the fly.
+    Hot documents (or memories appended after compaction) are returned as stored."""
+    memories = doc_data.get("memories", [])
+    if doc_data.get("storage_tier") != COLD_TIER or not doc_data.get("transcripts_zstd"):
+        return memories
+
+    transcripts = decompress_transcripts(firestore_client, doc_data["transcripts_zstd"], doc_data.get("transcripts_dict_id"))
+    if isinstance(transcripts, dict):
+        # Blobs written before transcripts were stored by position were keyed by memory_id
+        transcripts = [transcripts.get(m.get("memory_id")) for m in memories]
+    hydrated = []
+    for i, memory in enumerate(memories):
+        # Memories appended after compaction sit past the end of the blob and keep their transcript
+        if "transcript" not in memory and i < len(transcripts) and transcripts[i]:
+            memory = {**memory, "transcript": transcripts[i]}
+        hydrated.append(memory)
+    return hydrated
+
+
+def _train_dictionary(firestore_client, samples: list):
+    """Trains and stores a new dictionary. Returns (dict_id, dictionary), or (None, None) if
+    there isn't enough sample data (we then compress without a dictionary)."""
+    try:
+        dictionary = zstandard.train_dictionary(DICTIONARY_SIZE_BYTES, samples)
+    except zstandard.ZstdError as e:
+        logging.warning(f"Could not train compression dictionary from {len(samples)} samples: {e}")
+        return None, None
+    dict_id = f"zstd-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+    firestore_client.collection(DICTIONARY_COLLECTION).document(dict_id).set({
+        "dictionary": dictionary.as_bytes(),
+        "sample_count": len(samples),
+        "created_at": firestore.SERVER_TIMESTAMP,
+    })
+    _dictionary_cache[dict_id] = dictionary
+    logging.info(f"Trained compression dictionary {dict_id} from {len(samples)} transcripts.")
+    return dict_id, dictionary
+
+
+def _current_dictionary(firestore_client, samples: list):
+    """Latest stored dictionary if it's recent enough, otherwise a freshly trained one."""
+    latest = list(firestore_client.collection(DICTIONARY_COLLECTION)
+                  .order_by("created_at", direction=firestore.Query.DESCENDING).limit(1).stream())
+    if latest:
+        created_at = latest[0].to_dict().get("created_at")
+        if created_at and created_at > datetime.now(timezone.utc) - timedelta(days=DICTIONARY_MAX_AGE_DAYS):
+            return latest[0].id, _load_dictionary(firestore_client, latest[0].id)
+    return _train_dictionary(firestore_client, samples)
+
+
+def _backfill_pending_flags(firestore_client):
+    """One-time full scan for documents written before the collector stamped `date` and
+    compaction_pending. Every later run only queries pending documents."""
+    state_ref = firestore_client.collection(SYSTEM_STATE_COLLECTION).document(COLD_STORAGE_STATE_DOC)
+    state = state_ref.get()
+    if state.exists and (state.to_dict() or {}).get("legacy_backfilled"):
+        return
+    batch, batch_size, stamped = firestore_client.batch(), 0, 0
+    for snapshot in firestore_client.collection("raw_memories").select(["storage_tier", "compaction_pending"]).stream():
+        data = snapshot.to_dict() or {}
+        if "compaction_pending" in data or "_" not in snapshot.id:
+            continue
+        batch.update(snapshot.reference, {
+            "date": snapshot.id.rsplit("_", 1)[1],
+            "compaction_pending": data.get("storage_tier") != COLD_TIER,
+        })
+        batch_size += 1
+        stamped += 1
+        if batch_size == 500: # Firestore batch limit
+            batch.commit()
+            batch, batch_size = firestore_client.batch(), 0
+    if batch_size:
+        batch.commit()
+    state_ref.set({"legacy_backfilled": True, "backfilled_at": firestore.SERVER_TIMESTAMP}, merge=True)
+    logging.info(f"Stamped {stamped} legacy raw_memories documents for compaction tracking.")
+
+
+def find_compaction_candidates(firestore_client, limit: int = RETENTION_MAX_DOCS_PER_RUN) -> list:
+    """
+    Pending raw_memories documents older than the retention window whose reflection exists, oldest
+    first. Days that still have no reflection NO_REFLECTION_GRACE_DAYS past the window (e.g. empty
+    transcripts never get one) are compacted anyway: readers decompress transparently, and it
+    clears their flag instead of re-checking them on every run.
+    """
+    _backfill_pending_flags(firestore_client)
+    today = datetime.now(timezone.utc).date()
+    cutoff = (today - timedelta(days=RETENTION_HOT_DAYS)).strftime("%Y-%m-%d")
+    no_reflection_cutoff = (today - timedelta(days=RETENTION_HOT_DAYS + NO_REFLECTION_GRACE_DAYS)).strftime("%Y-%m-%d")
+    # Only pending days are read (field mask: IDs, not transcripts), bounded per run; days still
+    # waiting for a reflection are the newest, so ordering by date keeps them from starving the rest
+    query = firestore_client.collection("raw_memories").where("compaction_pending", "==", True) \
+        .where("date", "<", cutoff).order_by("date").limit(limit * 2).select(["date"])
+    candidates = [(snapshot.id, (snapshot.to_dict() or {}).get("date", "")) for snapshot in query.stream()]
+
+    ready = [doc_id for doc_id, date_str in candidates if date_str < no_reflection_cutoff]
+    waiting = [doc_id for doc_id, date_str in candidates if date_str >= no_reflection_cutoff]
+    # Within the grace period, only days that already have a reflection (reprocessed only occasionally from here on)
+    for start in range(0, len(waiting), 100):
+        if len(ready) >= limit:
+            break
+        refs = [firestore_client.collection("daily_reflections").document(d) for d in waiting[start:start + 100]]
+        ready.extend(s.id for s in firestore_client.get_all(refs) if s.exists)
+    return ready[:limit]
+
+
+def compact_day(firestore_client, doc_id: str, compressor, dict_id: str | None) -> tuple:
+    """Moves one day's transcripts into a compressed blob. Returns (bytes_before, bytes_after)."""
+    doc_ref = firestore_client.collection("raw_memories").document(doc_id)
+    snapshot = doc_ref.get()
+    if not snapshot.exists:
+        return 0, 0
+    data = snapshot.to_dict() or {}
+    if data.get("storage_tier") == COLD_TIER:
+        # A late webhook re-flagged it; its appended memories just keep their plaintext transcript
+        doc_ref.update({"compaction_pending": False})
+        return 0, 0
+
+    memories = data.get("memories", [])
+    # By position, not memory_id: a retried webhook can store two entries with the same ID
+    transcripts = [m.get("transcript") or None for m in memories]
+    raw = json.dumps(transcripts, ensure_ascii=False).encode("utf-8")
+    blob = compressor.compress(raw)
+    stripped = [{k: v for k, v in m.items() if k != "transcript"} for m in memories]
+
+    # Precondition on update_time: if a late webhook appended a memory meanwhile, skip this run
+    doc_ref.update({
+        "memories": stripped,
+        "transcripts_zstd": blob,
+        "transcripts_dict_id": dict_id,
+        "storage_tier": COLD_TIER,
+        "compaction_pending": False,
+        "compacted_at": firestore.SERVER_TIMESTAMP,
+    }, option=firestore_client.write_option(last_update_time=snapshot.update_time))
+    return len(raw), len(blob)
+
+
+def run_compaction(firestore_client) -> dict:
+    """Compacts up to RETENTION_MAX_DOCS_PER_RUN eligible days. Safe to re-run (already-cold docs are skipped)."""
+    doc_ids = find_compaction_candidates(firestore_client)
+    summary = {"candidates": len(doc_ids), "compacted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    if not doc_ids:
+        return summary
+
+    # Training samples: transcripts from (up to) the first candidate days of this run
+    samples = []
+    for snapshot in firestore_client.get_all([firestore_client.collection("raw_memories").document(d) for d in doc_ids[:200]]):
+        for memory in (snapshot.to_dict() or {}).get("memories", []):
+            if memory.get("transcript"):
+                samples.append(memory["transcript"].encode("utf-8"))
+        if len(samples) >= DICTIONARY_MAX_SAMPLES:
+            break
+    dict_id, dictionary = _current_dictionary(firestore_client, samples)
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary) if dictionary \
+        else zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+
+    for doc_id in doc_ids:
+        try:
+            before, after = compact_day(firestore_client, doc_id, compressor, dict_id)
+        except Exception as e:
+            # FailedPrecondition (concurrent write) or transient errors: the next run retries
+            logging.warning(f"Skipping compaction of {doc_id}: {e}")
+            summary["skipped"] += 1
+            continue
+        if before:
+            summary["compacted"] += 1
+            summary["bytes_before"] += before
+            summary["bytes_after"] += after
+    return summary
@@ -0,0 +1,52 @@
+import os
+import zlib
+from datetime import datetime, timedelta
+import pytz
+
+# --- Load-Levelling End-of-Day Scheduler ---
+# Instead of one nightly Cloud Scheduler job processing every user at 9 PM PT, a frequent
+# "tick" (e.g. every 15 minutes) asks: whose local day has ended since we last processed them?
+# Each user's day is processed shortly after *their* local midnight, plus a stable per-user
+# offset, so OpenAI and Firestore load is spread across all 24 hours instead of one spike.
+
+# Wait this long after local midnight so late webhooks for the day can land first
+END_OF_DAY_GRACE_MINUTES = int(os.environ.get("END_OF_DAY_GRACE_MINUTES", "30"))
+# Users in the same timezone are spread over this window (stable per uid)
+SPREAD_WINDOW_MINUTES = int(os.environ.get("SPREAD_WINDOW_MINUTES", "120"))
+# After an outage, catch up at most this many days back (older days: use reprocess_reflections)
+CATCH_UP_MAX_DAYS = int(os.environ.get("CATCH_UP_MAX_DAYS", "7"))
+# A day that keeps failing is given up after this many ticks, so it can't block the days after it
+MAX_DAY_ATTEMPTS = int(os.environ.get("EOD_MAX_DAY_ATTEMPTS", "3"))
+
+
+def user_offset_minutes(uid: str) -> int:
+    """Stable per-user offset in [0, SPREAD_WINDOW_MINUTES) so same-timezone users don't all fire together."""
+    if SPREAD_WINDOW_MINUTES <= 0:
+        return 0
+    # crc32 (not hash()) so the offset is identical across processes and restarts
+    return zlib.crc32(uid.encode("utf-8")) % SPREAD_WINDOW_MINUTES
+
+
+def due_date_for_user(uid: str, tz_name: str, now_utc: datetime, last_processed_date: str | None) -> str | None:
+    """
+    Returns the local YYYY-MM-DD that should be processed for this user right now, or None.
+
+    A day is due once local time passes midnight + grace + the user's offset, and it hasn't
+    already been processed (tracked via last_processed_date). The OLDEST unprocessed day is
+    returned (last_processed_date + 1, but no more than CATCH_UP_MAX_DAYS back), so after missed
+    ticks or an outage each following tick processes the next day until the user is caught up.
+    """
+    tz = pytz.timezone(tz_name)
+    now_local = now_utc.astimezone(tz)
+    delay = timedelta(minutes=END_OF_DAY_GRACE_MINUTES + user_offset_minutes(uid))
+
+    # The most recent local day whose end (+ delay) has already passed
+    latest = (now_local - delay).date() - timedelta(days=1)
+    if not last_processed_date:
+        return latest.strftime('%Y-%m-%d') # New user: start with the day that just ended
+
+    next_day = datetime.strptime(last_processed_date, '%Y-%m-%d').date() + timedelta(days=1)
+    if next_day > latest:
+        return None
+    oldest_allowed = latest - timedelta(days=max(CATCH_UP_MAX_DAYS, 1) - 1)
+    return max(next_day, oldest_allowed).strftime('%Y-%m-%d')
@@ -1,13 +1,24 @@
 import os
 import json
+import time
+import uuid
 import logging
 import functions_framework # Google Cloud Functions framework
 from datetime import datetime, timezone, timedelta
 from google.cloud import firestore
-from google.api_core.exceptions import GoogleAPICallError, NotFound
+from google.api_core.exceptions import GoogleAPICallError, Conflict
 import openai
 import httpx # Import httpx
-import pytz 
+
+import user_timezones # Per-user timezone registry shared (by convention) with the collector
+import eod_scheduler # Load-levelling end-of-day scheduling
+import transcript_compaction # Deterministic transcript shrinking before the OpenAI call
+import reflection_schema # Typed schema validation/repair for the OpenAI response
+import batch_mode # Batch API submission for non-urgent nightly processing
+import cold_storage # Tiered retention: compressed transcripts for old days
+import reprocessing # Checkpointed regeneration of history after prompt/model changes
+import reflection_events # "Reflection ready" notifications for connected clients
+import action_item_tracker # Cross-day action-item store with near-duplicate merging
 
 from dotenv import load_dotenv
 
@@ -20,6 +31,10 @@ load_dotenv()
 # --- Environment Variables (Read at Function Startup) ---
 # These MUST be set when deploying the function
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# Transcript compaction (fillers, stutters, duplicate segments) before calling OpenAI
+TRANSCRIPT_COMPACTION_ENABLED = os.environ.get("TRANSCRIPT_COMPACTION_ENABLED", "true").lower() == "true"
+# Optional extractive trim to this many (estimated) tokens; 0 disables trimming
+TRANSCRIPT_TOKEN_BUDGET = int(os.environ.get("TRANSCRIPT_TOKEN_BUDGET", "0"))
 # We'll get User ID from request for testing, or could be env var for single user
 # TARGET_USER_ID = os.environ.get("TARGET_USER_ID") # Optional: For single-user focus
 
@@ -61,20 +76,37 @@ except Exception as e:
     clients_initialized = False # Ensure flag is False
 
 # --- Helper: OpenAI Processing ---
-def process_transcript_with_openai(transcript: str) -> dict:
+default_error_response = {
+    "daily_emoji": "⚠️", "summary": "AI Processing Failed", "gratitude_points": [],
+    "learned_terms": [], "little_things": [], "mentor_advice": "Could not generate advice.",
+    "action_items": []
+}
+
+SYSTEM_PROMPT = "You are an AI assistant analyzing daily conversation transcripts. Output structured JSON containing insightful summaries, actionable items (be detailed on the tasks, be succinct with the rest), learned concepts, and supportive advice."
+REFLECTION_MODEL = "gpt-4o-mini"
+# Bump PROMPT_VERSION whenever build_reflection_prompt changes (and register the new builder in
+# PROMPT_BUILDERS). Every reflection is stamped with prompt_version + model so stale ones can be
+# found with an equality (!=) query (versions are strings, never compare them with <) and regenerated via reprocess_reflections.
+PROMPT_VERSION = "v1"
+REFLECTION_MAX_TOKENS = 1000 # Increase if summaries/lists get truncated
+REFLECTION_TEMPERATURE = 0.6 # Balanced temperature
+
+
+def process_transcript_with_openai(transcript: str, prompt_version: str = PROMPT_VERSION, model: str = REFLECTION_MODEL) -> dict:
     """Uses OpenAI to generate structured reflection data from transcript."""
-    default_error_response = {
-        "daily_emoji": "⚠️", "summary": "AI Processing Failed", "gratitude_points": [],
-        "learned_terms": [], "little_things": [], "mentor_advice": "Could not generate advice.",
-        "action_items": []
-    }
-
     if not openai_client or not transcript:
         logging.warning("Skipping OpenAI processing (client unavailable or empty transcript).")
         return default_error_response
 
-    logging.info(f"Processing transcript ({len(transcript)} chars) with OpenAI...")
-    prompt = f"""
+    logging.info(f"Processing transcript ({len(transcript)} chars) with OpenAI ({model}, prompt {prompt_version})...")
+    prompt = PROMPT_BUILDERS[prompt_version](transcript)
+    content = _call_openai_json(prompt, max_tokens=REFLECTION_MAX_TOKENS, model=model)
+    return reflection_from_content(content, transcript, model=model)
+
+
+def build_reflection_prompt(transcript: str) -> str:
+    """Renders the full reflection prompt for a day's (compacted) transcript."""
+    return f"""
         Analyze the following conversation transcript(s) from an entire day captured by the Omi Device V2. Your goal is to provide insights that are personalized, supportive, and encourage reflection and gratitude. Focus on extracting meaning and actionable observations *directly* from the user's interactions.
 
         Provide the following details in JSON format:
@@ -118,45 +150,91 @@ def process_transcript_with_openai(transcript: str) -> dict:
         ]
         }}
     """
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            response_format={ "type": "json_object" },
-            messages=[
-                {"role": "system", "content": "You are an AI assistant analyzing daily conversation transcripts. Output structured JSON containing insightful summaries, actionable items (be detailed on the tasks, be succinct with the rest), learned concepts, and supportive advice."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000, # Increase if summaries/lists get truncated
-            temperature=0.6 # Balanced temperature
+
+
+# Prompt builders by version. Keep old versions here while history still references them.
+PROMPT_BUILDERS = {
+    "v1": build_reflection_prompt,
+}
+
+
+def reflection_from_content(content, transcript, model: str = REFLECTION_MODEL) -> dict:
+    """Turns a raw model response into a reflection dict: keeps valid fields, coerces recoverable
+    ones and re-requests only the missing keys (see reflection_schema)."""
+    if content is None:
+        reflection_schema.count("full_failures")
+        reflection_schema.log_counters()
+        return default_error_response
+
+    # --- Validate & repair instead of discarding the whole response ---
+    reflection_schema.count("responses")
+    processed_data = reflection_schema.parse_json_leniently(content)
+    if processed_data is None:
+        logging.error(f"Failed to parse JSON from OpenAI. Response: {content}")
+        reflection_schema.count("parse_failures")
+        processed_data, missing_keys = {}, list(reflection_schema.REQUIRED_KEYS)
+        reflection_schema.count("fields_missing", len(missing_keys))
+    else:
+        processed_data, missing_keys = reflection_schema.validate_reflection(processed_data)
+
+    if missing_keys:
+        logging.warning(f"OpenAI response missing/invalid keys {missing_keys}, requesting only those fields.")
+        if callable(transcript):
+            # Batch mode passes a loader so the transcript is only re-read when a repair is needed
+            transcript = transcript()
+        reflection_schema.count("responses_needing_repair")
+        followup_content = _call_openai_json(
+            reflection_schema.build_followup_prompt(transcript, missing_keys), max_tokens=600, model=model
         )
+        followup_data = reflection_schema.parse_json_leniently(followup_content)
+        if followup_data:
+            repaired, missing_keys = reflection_schema.validate_reflection(followup_data, keys=missing_keys)
+            processed_data.update(repaired)
+        if missing_keys:
+            logging.error(f"Could not repair keys {missing_keys}, filling with defaults.")
+        else:
+            reflection_schema.count("responses_repaired")
+
+    if len(missing_keys) == len(reflection_schema.REQUIRED_KEYS):
+        reflection_schema.count("full_failures")
+        reflection_schema.log_counters()
+        return default_error_response
+
+    reflection_schema.count("fields_defaulted", len(missing_keys))
+    for key in missing_keys:
+        processed_data[key] = default_error_response[key]
+    reflection_schema.log_counters()
+    logging.info("OpenAI processing successful.")
+    return processed_data
+
+
+def chat_request_body(prompt: str, max_tokens: int = REFLECTION_MAX_TOKENS, model: str = REFLECTION_MODEL) -> dict:
+    """Chat completion request parameters; shared by interactive calls and batch files."""
+    return {
+        "model": model,
+        "response_format": { "type": "json_object" },
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": REFLECTION_TEMPERATURE,
+    }
+
+
+def _call_openai_json(prompt: str, max_tokens: int, model: str = REFLECTION_MODEL):
+    """Makes one JSON-mode chat completion. Returns the raw content string, or None on failure."""
+    try:
+        response = openai_client.chat.completions.create(**chat_request_body(prompt, max_tokens, model))
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             content = response.choices[0].message.content.strip()
             logging.info(f"OpenAI Raw Response: {content}")
-            try:
-                processed_data = json.loads(content)
-                # Basic validation (check if all keys exist)
-                required_keys = ["daily_emoji", "summary", "gratitude_points", "learned_terms", "little_things", "mentor_advice", "action_items"]
-                if all(k in processed_data for k in required_keys):
-                     # Further validation/cleaning (ensure arrays are lists)
-                    for key in ["gratitude_points", "learned_terms", "little_things", "action_items"]:
-                        if not isinstance(processed_data.get(key), list):
-                            logging.warning(f"OpenAI response for '{key}' was not a list, correcting to empty list.")
-                            processed_data[key] = []
-                    logging.info("OpenAI processing successful.")
-                    return processed_data
-                else:
-                    missing_keys = [k for k in required_keys if k not in processed_data]
-                    logging.error(f"OpenAI response missing required JSON keys: {missing_keys}")
-                    return default_error_response
-            except json.JSONDecodeError as json_err:
-                logging.error(f"Failed to parse JSON from OpenAI: {json_err}. Response: {content}")
-                return default_error_response
-        else:
-            logging.error("OpenAI response structure was unexpected or empty.")
-            return default_error_response
+            return content
+        logging.error("OpenAI response structure was unexpected or empty.")
+        return None
     except Exception as e:
         logging.error(f"Error calling OpenAI API: {e}")
-        return default_error_response
+        return None
 
 # --- Cloud Function Entry Point ---
 @functions_framework.http # Decorator to make this an HTTP-triggered function
@@ -183,35 +261,13 @@ def daily_process_memories(request):
         target_date_str = explicit_date_str
         logging.info(f"Processing reflections for User ID: {user_id}, Using explicit Date: {target_date_str}")
     else:
-        # No date provided (likely triggered by scheduler), calculate based on target timezone
+        # No date provided, calculate "today" in the user's registered timezone.
+        # This must match how the collector buckets raw_memories ({uid}_{local date}).
+        # Note: the end-of-day scheduler (schedule_end_of_day_processing) always passes
+        # an explicit, already-finished day instead of relying on this.
         try:
-            # Define the target timezone (e.g., Pacific Time)
-            target_tz_name = "America/Los_Angeles" # Pacific Time zone
-            target_tz = pytz.timezone(target_tz_name)
-
-            # Get the current time in UTC
-            now_utc = datetime.now(timezone.utc)
-
-            # Convert current UTC time to the target timezone
-            now_target_tz = now_utc.astimezone(target_tz)
-
-            # --- Decide which day to process ---
-            # If the job runs late at night (e.g., 9 PM PT), 'now_target_tz.date()' IS the day we want to process.
-            # If the job runs early morning (e.g., 2 AM PT), 'now_target_tz.date()' is technically the *next* day,
-            # so we actually want to process the day *before* 'now_target_tz.date()'.
-
-            # Let's assume the scheduler runs EOD/Night (like 9 PM PT).
-            # In this case, the date part of the current time in the target timezone IS the correct date to process.
-            target_date = now_target_tz.date()
-
-            # --- Alternative logic if running EARLY morning (e.g., 2 AM PT) ---
-            # If you schedule the job for after midnight in your local time (e.g., 2 AM PT),
-            # you want the *previous* day's data. Uncomment the next two lines in that case:
-            # target_date = now_target_tz.date() - timedelta(days=1)
-            # logging.info(f"Scheduler running early morning, processing previous day: {target_date.strftime('%Y-%m-%d')}")
-            # --- End Alternative logic ---
-
-            target_date_str = target_date.strftime('%Y-%m-%d')
+            target_tz_name = user_timezones.get_user_timezone_name(firestore_client, user_id)
+            target_date_str = user_timezones.local_date_str(datetime.now(timezone.utc), target_tz_name)
             logging.info(f"Processing reflections for User ID: {user_id}, Calculated Target Date ({target_tz_name}): {target_date_str}")
 
         except Exception as e:
@@ -220,6 +276,32 @@ def daily_process_memories(request):
             target_date_str = datetime.now(timezone.utc).strftime('%Y-%m-%d')
             logging.warning(f"Processing reflections for User ID: {user_id}, Using UTC Date Fallback: {target_date_str}")
 
+    return process_user_day(user_id, target_date_str)
+
+
+# --- Core Processing for a Single User-Day ---
+def process_user_day(user_id: str, target_date_str: str, prompt_version: str = PROMPT_VERSION, model: str = REFLECTION_MODEL):
+    """Reads raw_memories for {user_id}_{target_date_str}, runs OpenAI, writes daily_reflections.
+    Returns a (message, http_status) tuple so HTTP entry points can return it directly."""
+    full_day_transcript, error = load_day_transcript(user_id, target_date_str)
+    if error:
+        return error
+
+    # --- Process with OpenAI ---
+    processed_data = process_transcript_with_openai(full_day_transcript, prompt_version, model)
+
+    error = save_reflection(user_id, target_date_str, processed_data, prompt_version, model)
+    if error:
+        return error
+
+    # --- Return Success ---
+    logging.info("Daily processing completed successfully.")
+    return ("Processing complete", 200) # HTTP Success
+
+
+def load_day_transcript(user_id: str, target_date_str: str):
+    """Reads and aggregates (and compacts) a user-day's transcripts.
+    Returns (transcript, None) when there's something to process, otherwise (None, (message, status))."""
     # --- Read Raw Memories from Firestore ---
     full_day_transcript = ""
     try:
@@ -229,11 +311,15 @@ def daily_process_memories(request):
 
         if doc_snapshot.exists:
             data = doc_snapshot.to_dict()
-            memories = data.get("memories", [])
+            # Old days may be in cold storage, this decompresses their transcripts transparently
+            memories = cold_storage.hydrate_memories(firestore_client, data)
             if memories:
                 # Aggregate transcripts, maybe sort by start time first if needed
                 # For simplicity, just join them
                 all_texts = [m.get("transcript", "") for m in memories if m.get("transcript")]
+                if TRANSCRIPT_COMPACTION_ENABLED:
+                    all_texts, compaction_stats = transcript_compaction.compact_transcripts(all_texts, TRANSCRIPT_TOKEN_BUDGET)
+                    logging.info(f"Transcript compaction: {compaction_stats}")
                 full_day_transcript = "\n\n---\n\n".join(all_texts) # Join with separators
                 logging.info(f"Found {len(memories)} memories. Aggregated transcript length: {len(full_day_transcript)}")
             else:
@@ -241,23 +327,26 @@ def daily_process_memories(request):
         else:
             logging.info(f"No raw memory document found for {doc_id}.")
             # Return success, as there's nothing to process
-            return (f"No data found for {user_id} on {target_date_str}", 200)
+            return None, (f"No data found for {user_id} on {target_date_str}", 200)
 
     except GoogleAPICallError as e:
         logging.error(f"Firestore API error reading raw_memories for {doc_id}: {e}")
-        return ("Error reading data from database", 500)
+        return None, ("Error reading data from database", 500)
     except Exception as e:
         logging.error(f"Unexpected error reading raw_memories for {doc_id}: {e}")
-        return ("Internal server error during data read", 500)
+        return None, ("Internal server error during data read", 500)
 
-    # --- Process with OpenAI ---
     if not full_day_transcript:
          logging.info("Transcript is empty after aggregation. Nothing to process with OpenAI.")
-         processed_data = {"message": "No transcript content found for the day."} # Indicate nothing to process
-         # Still save a record? Optional. Let's just return for now.
-         return (f"No transcript content found for {user_id} on {target_date_str}", 200)
-    else:
-         processed_data = process_transcript_with_openai(full_day_transcript)
+         return None, (f"No transcript content found for {user_id} on {target_date_str}", 200)
+
+    return full_day_transcript, None
+
+
+def save_reflection(user_id: str, target_date_str: str, processed_data: dict, prompt_version: str = PROMPT_VERSION, model: str = REFLECTION_MODEL):
+    """Writes a reflection to daily_reflections. Returns None on success, or (message, status) on error."""
+    if processed_data is default_error_response:
+        return save_failure_placeholder(user_id, target_date_str)
 
     # --- Write Processed Results to Firestore ---
     try:
@@ -267,9 +356,22 @@ def daily_process_memories(request):
         # Add processing timestamp
         processed_data_to_save = processed_data.copy() # Avoid modifying original dict if reused
         processed_data_to_save["processed_at"] = firestore.SERVER_TIMESTAMP
+        # Version stamp, so reflections from an older prompt/model can be found and regenerated
+        processed_data_to_save["prompt_version"] = prompt_version
+        processed_data_to_save["model"] = model
+        # Queryable owner/date fields for the collector's delta endpoint (/reflections/changes)
+        processed_data_to_save["uid"] = user_id
+        processed_data_to_save["date"] = target_date_str
 
         processed_doc_ref.set(processed_data_to_save)
         logging.info(f"Successfully saved processed reflection to Firestore doc: {processed_doc_id}")
+        reflection_events.publish_reflection_ready(firestore_client, user_id, target_date_str, prompt_version)
+        try:
+            # Best effort: the reflection itself is saved, the tracker catches up on the next write
+            summary = action_item_tracker.record_action_items(firestore_client, user_id, target_date_str, processed_data.get("action_items", []))
+            logging.info(f"Action items for {processed_doc_id}: {summary}")
+        except Exception as e:
+            logging.error(f"Failed to update action-item store for {processed_doc_id}: {e}")
 
     except GoogleAPICallError as e:
         logging.error(f"Firestore API error writing daily_reflections for {processed_doc_id}: {e}")
@@ -278,7 +380,391 @@ def daily_process_memories(request):
     except Exception as e:
         logging.error(f"Unexpected error writing daily_reflections for {processed_doc_id}: {e}")
         return ("Internal server error during data save", 500)
+    return None
 
-    # --- Return Success ---
-    logging.info("Daily processing completed successfully.")
-    return ("Processing complete", 200) # HTTP Success
\ No newline at end of file
+
+def save_failure_placeholder(user_id: str, target_date_str: str):
+    """
+    OpenAI produced nothing usable. The error placeholder is only written when the day has no
+    reflection yet (so the app can show the failure), never over an existing one, and it carries
+    no version stamp, so a reprocessing plan still picks the day up. Always returns a non-200
+    status so callers retry the day instead of recording it as processed.
+    """
+    doc_id = f"{user_id}_{target_date_str}"
+    placeholder = {**default_error_response, "processed_at": firestore.SERVER_TIMESTAMP, "uid": user_id, "date": target_date_str}
+    try:
+        firestore_client.collection('daily_reflections').document(doc_id).create(placeholder)
+        logging.warning(f"AI processing failed, wrote error placeholder to {doc_id}")
+        reflection_events.publish_reflection_ready(firestore_client, user_id, target_date_str, None)
+    except Conflict:
+        logging.warning(f"AI processing failed, keeping the existing reflection {doc_id}")
+    except Exception as e:
+        logging.error(f"Failed to write error placeholder for {doc_id}: {e}")
+    return ("AI processing failed", 502)
+
+
+def record_day_failure(settings_ref, target_date_str: str, settings: dict | None = None, extra_fields: dict | None = None) -> bool:
+    """
+    Counts a failed attempt at a user-day in user_settings (failed_date/failed_attempts).
+    Catch-up goes oldest day first, so after eod_scheduler.MAX_DAY_ATTEMPTS failures the day is
+    given up (recorded as processed) instead of blocking, and re-billing, every later day.
+    Shared by the scheduler and both batch-mode paths. Returns True if the day was given up.
+    """
+    if settings is None:
+        snapshot = settings_ref.get()
+        settings = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    attempts = settings.get("failed_attempts", 0) + 1 if settings.get("failed_date") == target_date_str else 1
+    update = dict(extra_fields or {})
+    if attempts >= eod_scheduler.MAX_DAY_ATTEMPTS:
+        logging.error(f"Giving up on {settings_ref.id} {target_date_str} after {attempts} attempts")
+        update.update({
+            "last_processed_date": target_date_str,
+            "failed_date": firestore.DELETE_FIELD, "failed_attempts": firestore.DELETE_FIELD,
+        })
+    else:
+        update.update({"failed_date": target_date_str, "failed_attempts": attempts})
+    settings_ref.set(update, merge=True)
+    return attempts >= eod_scheduler.MAX_DAY_ATTEMPTS
+
+
+# --- Cloud Function Entry Point: End-of-Day Scheduler Tick ---
+# Trigger this frequently (e.g. Cloud Scheduler "*/15 * * * *") instead of one nightly job.
+# Each tick processes only the users whose local day just ended, spreading load over 24h.
+# Deploy with a timeout above SCHEDULER_TIME_BUDGET_SECONDS (e.g. --timeout=540s): users left
+# when the budget is spent are picked up by the next tick.
+MAX_USERS_PER_TICK = int(os.environ.get("MAX_USERS_PER_TICK", "50"))
+SCHEDULER_TIME_BUDGET_SECONDS = int(os.environ.get("SCHEDULER_TIME_BUDGET_SECONDS", "420"))
+# How long a tick's claim on a user-day lasts; a crashed tick's claims expire after this
+USER_DAY_CLAIM_SECONDS = int(os.environ.get("USER_DAY_CLAIM_SECONDS", "900"))
+
+
+@firestore.transactional
+def _claim_user_day(transaction, settings_ref, target_date_str: str):
+    """Claims the user-day for this tick. Returns fresh settings, or None if it's already done
+    or claimed by another (overlapping or retried) tick, so no user-day is processed twice."""
+    snapshot = settings_ref.get(transaction=transaction)
+    settings = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    now = datetime.now(timezone.utc)
+    if (settings.get("last_processed_date") or "") >= target_date_str:
+        return None
+    claimed_until = settings.get("processing_until")
+    if settings.get("processing_date") == target_date_str and claimed_until and claimed_until > now:
+        return None
+    transaction.set(settings_ref, {
+        "processing_date": target_date_str,
+        "processing_until": now + timedelta(seconds=USER_DAY_CLAIM_SECONDS),
+    }, merge=True)
+    return settings
+
+
+@functions_framework.http
+def schedule_end_of_day_processing(request):
+    """HTTP Cloud Function: processes every user whose local day has ended and isn't processed yet."""
+    logging.info("End-of-day scheduler tick triggered.")
+
+    if not clients_initialized:
+        logging.error("Clients not initialized. Aborting scheduler tick.")
+        return ("Server configuration error", 500)
+
+    now_utc = datetime.now(timezone.utc)
+    deadline = time.monotonic() + SCHEDULER_TIME_BUDGET_SECONDS
+    tick_id = uuid.uuid4().hex
+    processed, failed, deferred, skipped_claimed = 0, 0, 0, 0
+    release_claim = {"processing_date": firestore.DELETE_FIELD, "processing_until": firestore.DELETE_FIELD}
+
+    try:
+        # Live work has priority: reprocessing runs pause while this tick's lease is held
+        reprocessing.acquire_live_lease(firestore_client, tick_id, SCHEDULER_TIME_BUDGET_SECONDS + 60)
+        # Read the settings up front: holding a query stream open across minutes of processing can time out
+        settings_docs = list(firestore_client.collection(user_timezones.USER_SETTINGS_COLLECTION).stream())
+        for settings_doc in settings_docs:
+            settings = settings_doc.to_dict() or {}
+            user_id = settings_doc.id
+            tz_name = user_timezones.timezone_from_settings(settings)
+
+            target_date_str = eod_scheduler.due_date_for_user(
+                user_id, tz_name, now_utc, settings.get("last_processed_date")
+            )
+            if not target_date_str or (settings.get("batch_pending_date") or "") >= target_date_str:
+                continue # Nothing due, or it's already in a submitted batch (batch_process_reflections)
+
+            # Bound the work per tick (count and time); anything left over is picked up by the next tick
+            if processed + failed >= MAX_USERS_PER_TICK or time.monotonic() >= deadline:
+                deferred += 1
+                continue
+
+            settings = _claim_user_day(firestore_client.transaction(), settings_doc.reference, target_date_str)
+            if settings is None:
+                skipped_claimed += 1
+                continue
+
+            logging.info(f"Scheduler: {user_id} ({tz_name}) is due for {target_date_str}")
+            message, status = process_user_day(user_id, target_date_str)
+            if status == 200:
+                settings_doc.reference.set({"last_processed_date": target_date_str, **release_claim}, merge=True)
+                processed += 1
+            else:
+                logging.error(f"Scheduler: processing failed for {user_id} on {target_date_str}: {message}")
+                failed += 1
+                record_day_failure(settings_doc.reference, target_date_str, settings, extra_fields=release_claim)
+
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error during scheduler tick: {e}")
+        return ("Error reading user settings", 500)
+    finally:
+        try:
+            reprocessing.release_live_lease(firestore_client, tick_id)
+        except GoogleAPICallError as e:
+            logging.warning(f"Could not release live-processing lease (it expires on its own): {e}")
+
+    summary = f"Scheduler tick complete: processed={processed}, failed={failed}, deferred={deferred}, claimed_elsewhere={skipped_claimed}"
+    logging.info(summary)
+    return (summary, 200)
+
+
+# --- Cloud Function Entry Point: Batch-File Mode ---
+# Alternative to the interactive scheduler for non-urgent processing. Schedule it twice:
+#   ?action=submit  (e.g. hourly)  renders every due user-day into one JSONL file and submits it
+#   ?action=poll    (e.g. every 15 min) checks submitted batches and fans results into daily_reflections
+# Progress lives in batch_jobs/{batch_id}, so a crashed or timed-out poll simply resumes next time.
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "5000"))
+
+@functions_framework.http
+def batch_process_reflections(request):
+    """HTTP Cloud Function: submit pending user-days as a batch, or poll/apply submitted batches."""
+    action = request.args.get("action", "poll")
+    logging.info(f"Batch reflection processing triggered (action={action}).")
+
+    if not clients_initialized:
+        logging.error("Clients not initialized. Aborting batch processing.")
+        return ("Server configuration error", 500)
+
+    backend = batch_mode.get_batch_backend()
+    if backend is None:
+        return ("Batch backend not configured", 500)
+
+    try:
+        if action == "submit":
+            return submit_reflection_batch(backend)
+        if action == "poll":
+            return poll_reflection_batches(backend)
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error during batch {action}: {e}")
+        return ("Database error during batch processing", 500)
+    except openai.OpenAIError as e:
+        logging.error(f"Batch API error during batch {action}: {e}")
+        return ("Batch API error", 502)
+    return (f"Unknown action '{action}' (use submit or poll)", 400)
+
+
+def submit_reflection_batch(backend):
+    """Collects every due, not-yet-submitted user-day, renders one batch file and submits it."""
+    now_utc = datetime.now(timezone.utc)
+    settings_coll = firestore_client.collection(user_timezones.USER_SETTINGS_COLLECTION)
+    writer = batch_mode.BatchFileWriter(BATCH_MAX_REQUESTS, batch_mode.BATCH_MAX_FILE_BYTES)
+    user_days = []
+
+    try:
+        for settings_doc in settings_coll.stream():
+            if writer.full():
+                logging.info("Batch is full, remaining users will go in the next batch.")
+                break
+            settings = settings_doc.to_dict() or {}
+            user_id = settings_doc.id
+            target_date_str = eod_scheduler.due_date_for_user(
+                user_id, user_timezones.timezone_from_settings(settings), now_utc, settings.get("last_processed_date")
+            )
+            # Skip users with nothing due, or whose due day is already in an in-flight batch
+            if not target_date_str or (settings.get("batch_pending_date") or "") >= target_date_str:
+                continue
+
+            transcript, result = load_day_transcript(user_id, target_date_str)
+            if result:
+                message, status = result
+                if status == 200:
+                    # Nothing to process that day, don't keep retrying it
+                    settings_doc.reference.set({"last_processed_date": target_date_str}, merge=True)
+                else:
+                    logging.error(f"Batch submit: skipping {user_id} on {target_date_str}: {message}")
+                    record_day_failure(settings_doc.reference, target_date_str, settings)
+                continue
+
+            # Written to the file right away; only the (small) user-day list stays in memory
+            if not writer.add(batch_mode.custom_id_for(user_id, target_date_str), chat_request_body(PROMPT_BUILDERS[PROMPT_VERSION](transcript))):
+                if writer.count == 0:
+                    # A single request over the file cap can never be submitted
+                    logging.error(f"Batch submit: request for {user_id} on {target_date_str} exceeds the batch file size cap")
+                    record_day_failure(settings_doc.reference, target_date_str, settings)
+                    continue
+                logging.info(f"Batch file reached {writer.bytes} bytes, remaining users will go in the next batch.")
+                break
+            user_days.append({"uid": user_id, "date": target_date_str})
+        writer.close()
+
+        if not user_days:
+            logging.info("No pending user-days to submit.")
+            return ("No pending user-days", 200)
+        batch_id = backend.submit(writer.path, metadata={"job": "daily_reflections"})
+    finally:
+        writer.discard()
+
+    # Checkpoint the job first, then mark users as pending so they aren't submitted twice
+    firestore_client.collection(batch_mode.BATCH_JOBS_COLLECTION).document(batch_id).set({
+        "state": "submitted",
+        "prompt_version": PROMPT_VERSION,
+        "model": REFLECTION_MODEL,
+        "user_days": user_days,
+        "applied": [],
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    })
+    for user_day in user_days:
+        settings_coll.document(user_day["uid"]).set({"batch_pending_date": user_day["date"]}, merge=True)
+
+    logging.info(f"Submitted batch {batch_id} with {len(user_days)} user-days ({writer.bytes} bytes).")
+    return (f"Submitted batch {batch_id} with {len(user_days)} user-days", 200)
+
+
+def poll_reflection_batches(backend):
+    """Checks every submitted batch; applies results of finished ones, resuming from the checkpoint."""
+    jobs_coll = firestore_client.collection(batch_mode.BATCH_JOBS_COLLECTION)
+    settings_coll = firestore_client.collection(user_timezones.USER_SETTINGS_COLLECTION)
+    summary = {"in_progress": 0, "applied": 0, "failed_requests": 0, "failed_batches": 0}
+
+    for job_doc in jobs_coll.where("state", "==", "submitted").stream():
+        batch_id = job_doc.id
+        job = job_doc.to_dict() or {}
+        status = backend.status(batch_id)
+        logging.info(f"Batch {batch_id} status: {status['status']}")
+
+        if status["status"] not in batch_mode.TERMINAL_SUCCESS | batch_mode.TERMINAL_FAILURE:
+            summary["in_progress"] += 1
+            continue
+
+        # Expired/cancelled batches can still carry partial output, apply whatever finished
+        results = batch_mode.parse_batch_output(backend.download(status["output_file_id"])) if status["output_file_id"] else {}
+        applied = set(job.get("applied", []))
+
+        for user_day in job.get("user_days", []):
+            user_id, date_str = user_day["uid"], user_day["date"]
+            custom_id = batch_mode.custom_id_for(user_id, date_str)
+            if custom_id in applied:
+                continue # Already written by an earlier (interrupted) poll
+
+            content = results.get(custom_id)
+            if content is None:
+                # Leave it for the next submit (clearing batch_pending_date makes the day due again),
+                # unless it has failed too often
+                summary["failed_requests"] += 1
+                record_day_failure(settings_coll.document(user_id), date_str, extra_fields={"batch_pending_date": firestore.DELETE_FIELD})
+            else:
+                job_model = job.get("model", REFLECTION_MODEL)
+                processed_data = reflection_from_content(
+                    content, lambda u=user_id, d=date_str: load_day_transcript(u, d)[0] or "", model=job_model
+                )
+                if save_reflection(user_id, date_str, processed_data, job.get("prompt_version", PROMPT_VERSION), job_model):
+                    summary["failed_requests"] += 1
+                    record_day_failure(settings_coll.document(user_id), date_str, extra_fields={"batch_pending_date": firestore.DELETE_FIELD})
+                else:
+                    summary["applied"] += 1
+                    settings_coll.document(user_id).set({
+                        "last_processed_date": date_str, "batch_pending_date": firestore.DELETE_FIELD,
+                        "failed_date": firestore.DELETE_FIELD, "failed_attempts": firestore.DELETE_FIELD,
+                    }, merge=True)
+
+            # Checkpoint per user-day so a restarted poll never re-applies (or re-bills a repair)
+            job_doc.reference.update({"applied": firestore.ArrayUnion([custom_id]), "updated_at": firestore.SERVER_TIMESTAMP})
+
+        final_state = "completed" if status["status"] in batch_mode.TERMINAL_SUCCESS else "failed"
+        if final_state == "failed":
+            summary["failed_batches"] += 1
+        job_doc.reference.update({"state": final_state, "provider_status": status["status"], "updated_at": firestore.SERVER_TIMESTAMP})
+
+    logging.info(f"Batch poll complete: {summary}")
+    return (f"Batch poll complete: {summary}", 200)
+
+
+# --- Cloud Function Entry Point: Retention / Cold Storage Compaction ---
+# Run daily (e.g. Cloud Scheduler "0 4 * * *"). Moves transcripts of days older than
+# RETENTION_HOT_DAYS that already have a reflection into zstd-compressed blobs.
+@functions_framework.http
+def compact_cold_raw_memories(request):
+    """HTTP Cloud Function: compresses old raw_memories transcripts into the cold tier."""
+    logging.info("Cold storage compaction triggered.")
+
+    if firestore_client is None:
+        logging.error("Firestore client not initialized. Aborting compaction.")
+        return ("Server configuration error", 500)
+
+    try:
+        summary = cold_storage.run_compaction(firestore_client)
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error during compaction: {e}")
+        return ("Error during compaction", 500)
+
+    if summary["bytes_before"]:
+        summary["ratio"] = round(summary["bytes_before"] / max(summary["bytes_after"], 1), 2)
+    logging.info(f"Cold storage compaction complete: {summary}")
+    return (f"Compaction complete: {summary}", 200)
+
+
+# --- Cloud Function Entry Point: Reprocessing Across History ---
+# After changing the prompt (bump PROMPT_VERSION) or the model:
+#   ?action=plan&uids=all|uid1,uid2&start=YYYY-MM-DD&end=YYYY-MM-DD[&prompt_version=v2&model=...]
+#       -> returns a run_id
+#   ?action=run&run_id=...    (schedule e.g. every 10 min until the run reports "completed")
+#   ?action=status&run_id=...
+@functions_framework.http
+def reprocess_reflections(request):
+    """HTTP Cloud Function: plan, run (resumably) or inspect a reprocessing run."""
+    action = request.args.get("action", "status")
+    logging.info(f"Reprocessing triggered (action={action}).")
+
+    if not clients_initialized:
+        logging.error("Clients not initialized. Aborting reprocessing.")
+        return ("Server configuration error", 500)
+
+    try:
+        if action == "plan":
+            prompt_version = request.args.get("prompt_version", PROMPT_VERSION)
+            model = request.args.get("model", REFLECTION_MODEL)
+            start, end = request.args.get("start"), request.args.get("end")
+            if prompt_version not in PROMPT_BUILDERS:
+                return (f"Unknown prompt_version '{prompt_version}' (known: {sorted(PROMPT_BUILDERS)})", 400)
+            if not start or not end:
+                return ("start and end (YYYY-MM-DD) are required", 400)
+
+            uids_arg = request.args.get("uids", "all")
+            if uids_arg == "all":
+                # From the data itself: user_settings only lists users with a webhook since timezones shipped
+                user_ids = reprocessing.users_with_raw_data(firestore_client, start, end)
+            else:
+                user_ids = [u.strip() for u in uids_arg.split(",") if u.strip()]
+
+            try:
+                run_id, item_count = reprocessing.plan_run(firestore_client, user_ids, start, end, prompt_version, model)
+            except ValueError as e:
+                return (f"Invalid date range: {e}", 400)
+            return (json.dumps({"run_id": run_id, "items": item_count}), 200)
+
+        run_id = request.args.get("run_id")
+        if not run_id:
+            return ("run_id is required", 400)
+
+        if action == "run":
+            try:
+                summary = reprocessing.run_pending(firestore_client, run_id, process_user_day)
+            except KeyError:
+                return (f"Unknown run_id '{run_id}'", 404)
+            return (json.dumps(summary), 200)
+
+        if action == "status":
+            snapshot = firestore_client.collection(reprocessing.RUNS_COLLECTION).document(run_id).get()
+            if not snapshot.exists:
+                return (f"Unknown run_id '{run_id}'", 404)
+            return (json.dumps(snapshot.to_dict(), default=str), 200)
+
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error during reprocessing {action}: {e}")
+        return ("Database error during reprocessing", 500)
+    return (f"Unknown action '{action}' (use plan, run or status)", 400)
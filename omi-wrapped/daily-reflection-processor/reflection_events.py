@@ -0,0 +1,64 @@
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+import httpx
+from google.cloud import firestore
+
+# --- "Reflection Ready" Events ---
+# After a reflection is written, the processor publishes an event so the collector can push it
+# to connected clients (SSE) instead of them polling /get_reflection until it stops 404-ing.
+# The pub/sub transport is pluggable (PUBSUB_BACKEND, set the same on both services):
+#   "firestore" (default): events are appended to reflection_events; the collector listens to
+#                          that collection and fans events out to its SSE subscribers.
+#   "memory":              events are POSTed to the collector's /reflections/publish hook, which
+#                          hands them to its in-process pub/sub (local testing without Firestore
+#                          listeners; run the collector with a single worker).
+
+EVENTS_COLLECTION = "reflection_events"
+PUBSUB_BACKEND = os.environ.get("PUBSUB_BACKEND", "firestore")
+REFLECTION_EVENTS_URL = os.environ.get("REFLECTION_EVENTS_URL", "http://localhost:8080/reflections/publish")
+# Events are only needed by currently connected listeners; configure a Firestore TTL policy on
+# reflection_events.expire_at so they get cleaned up automatically
+EVENT_TTL = timedelta(days=1)
+
+
+class FirestorePublisher:
+    def __init__(self, firestore_client):
+        self.firestore_client = firestore_client
+
+    def publish(self, event: dict):
+        self.firestore_client.collection(EVENTS_COLLECTION).add({
+            **event,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "expire_at": datetime.now(timezone.utc) + EVENT_TTL,
+        })
+
+
+class HttpPublisher:
+    """Delivers events straight to a (local) collector's in-process pub/sub."""
+
+    def __init__(self, url: str = REFLECTION_EVENTS_URL):
+        self.url = url
+        self.client = httpx.Client(timeout=5.0)
+
+    def publish(self, event: dict):
+        self.client.post(self.url, json=event).raise_for_status()
+
+
+_publisher = None
+
+
+def get_publisher(firestore_client):
+    global _publisher
+    if _publisher is None:
+        _publisher = HttpPublisher() if PUBSUB_BACKEND == "memory" else FirestorePublisher(firestore_client)
+    return _publisher
+
+
+def publish_reflection_ready(firestore_client, user_id: str, date_str: str, prompt_version: str):
+    """Best effort: a failed notification must never fail the reflection write itself."""
+    event = {"type": "reflection_ready", "uid": user_id, "date": date_str, "prompt_version": prompt_version}
+    try:
+        get_publisher(firestore_client).publish(event)
+    except Exception as e:
+        logging.error(f"Failed to publish reflection_ready for {user_id}_{date_str}: {e}")
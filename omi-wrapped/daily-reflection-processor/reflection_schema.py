@@ -0,0 +1,205 @@
+import re
+import json
+import threading
+import logging
+from collections import Counter
+from typing import TypedDict
+
+# --- Reflection Schema Validation & Repair ---
+# Instead of throwing away a whole OpenAI response when one key is missing or malformed,
+# we keep every field that is valid, coerce the ones that are recoverable (e.g. a string
+# where a list was expected), and report which fields still need a (small) follow-up request.
+
+
+class LearnedTerm(TypedDict):
+    term: str
+    definition: str
+
+
+class LittleThing(TypedDict):
+    mention: str
+    suggested_action: str
+
+
+class Reflection(TypedDict):
+    daily_emoji: str
+    summary: str
+    gratitude_points: list[str]
+    learned_terms: list[LearnedTerm]
+    little_things: list[LittleThing]
+    mentor_advice: str
+    action_items: list[str]
+
+
+REQUIRED_KEYS = list(Reflection.__annotations__.keys())
+
+# Short per-field instructions, used for targeted follow-up requests for missing fields only
+FIELD_INSTRUCTIONS = {
+    "daily_emoji": 'A single standard emoji representing the overall mood or primary theme of the day.',
+    "summary": 'A brief, personal summary (2-4 sentences) of the day.',
+    "gratitude_points": 'A JSON array of 2-3 strings highlighting specific positive moments from the conversations.',
+    "learned_terms": 'A JSON array of 3-5 objects: [{"term": "...", "definition": "..."}] for jargon/concepts mentioned.',
+    "little_things": 'A JSON array of 2-4 objects: [{"mention": "...", "suggested_action": "..."}] for small actionable observations.',
+    "mentor_advice": 'A single constructive, concise piece of advice (1-2 sentences) citing a specific interaction.',
+    "action_items": 'A JSON array of strings: concrete tasks explicitly stated as needing to be done by the user.',
+}
+
+# Per-response counters. log_counters() emits what was counted since the previous call (on this
+# thread) and resets, so each "reflection_schema_counters" log line carries one response's
+# increments: a log-based metric can simply sum them across calls, instances and cold starts.
+_local_counters = threading.local()
+
+
+def count(name: str, n: int = 1):
+    if not hasattr(_local_counters, "counts"):
+        _local_counters.counts = Counter()
+    _local_counters.counts[name] += n
+
+
+def parse_json_leniently(content: str):
+    """Parses model output as JSON, salvaging common breakage (code fences, prose around the
+    object, trailing commas). Returns a dict or None."""
+    if not content:
+        return None
+    try:
+        data = json.loads(content)
+        return data if isinstance(data, dict) else None
+    except json.JSONDecodeError:
+        pass
+
+    count("json_salvage_attempts")
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    candidate = content[start:end + 1]
+    # Trailing commas before a closing bracket/brace
+    candidate = re.sub(r",\s*([\]}])", r"\1", candidate)
+    # Missing comma between two adjacent string items on separate lines
+    candidate = re.sub(r'"\s*\n(\s*)"', '",\n\\1"', candidate)
+    try:
+        data = json.loads(candidate)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, dict):
+        count("json_salvaged")
+        return data
+    return None
+
+
+def _as_string(value):
+    if isinstance(value, str):
+        return value.strip() or None
+    if isinstance(value, list):
+        parts = [str(v).strip() for v in value if isinstance(v, (str, int, float)) and str(v).strip()]
+        return " ".join(parts) or None
+    if isinstance(value, (int, float)):
+        return str(value)
+    return None
+
+
+def _as_string_list(value):
+    if isinstance(value, str):
+        # A single string, possibly a newline / bullet separated list
+        items = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip() for line in value.splitlines()]
+        items = [i for i in items if i]
+        return items if items else None
+    if not isinstance(value, list):
+        return None
+    items = []
+    for item in value:
+        if isinstance(item, str) and item.strip():
+            items.append(item.strip())
+        elif isinstance(item, dict):
+            # e.g. [{"task": "..."}] -> take the first non-empty string value
+            text = next((v.strip() for v in item.values() if isinstance(v, str) and v.strip()), None)
+            if text:
+                items.append(text)
+    return items
+
+
+def _as_pair_list(value, first_key: str, second_key: str, aliases: dict):
+    """Coerces to a list of {first_key, second_key} dicts. Accepts a {first: second} mapping,
+    "first: second" strings, and dicts using alias key names."""
+    if isinstance(value, dict):
+        if first_key in value:
+            value = [value]
+        else:
+            value = [{first_key: k, second_key: v} for k, v in value.items()]
+    if not isinstance(value, list):
+        return None
+
+    pairs = []
+    for item in value:
+        if isinstance(item, str):
+            head, sep, tail = item.partition(":")
+            if sep and head.strip():
+                pairs.append({first_key: head.strip(), second_key: tail.strip()})
+            continue
+        if not isinstance(item, dict):
+            continue
+        normalized = {aliases.get(k, k): v for k, v in item.items()}
+        first, second = _as_string(normalized.get(first_key)), _as_string(normalized.get(second_key))
+        if first:
+            pairs.append({first_key: first, second_key: second or ""})
+    return pairs
+
+
+_COERCERS = {
+    "daily_emoji": _as_string,
+    "summary": _as_string,
+    "mentor_advice": _as_string,
+    "gratitude_points": _as_string_list,
+    "action_items": _as_string_list,
+    "learned_terms": lambda v: _as_pair_list(v, "term", "definition", {"name": "term", "meaning": "definition", "context": "definition"}),
+    "little_things": lambda v: _as_pair_list(v, "mention", "suggested_action", {"observation": "mention", "action": "suggested_action", "suggestion": "suggested_action"}),
+}
+
+
+def validate_reflection(data: dict, keys: list | None = None) -> tuple:
+    """
+    Validates/coerces a parsed model response against the Reflection schema
+    (or only the given subset of keys).
+    Returns (clean_fields, missing_keys): clean_fields only contains keys that are valid
+    (possibly after coercion); missing_keys lists keys that are absent or unrecoverable.
+    """
+    data = data or {}
+    clean, missing = {}, []
+    for key in keys or REQUIRED_KEYS:
+        if key not in data or data[key] is None:
+            missing.append(key)
+            continue
+        raw = data[key]
+        value = _COERCERS[key](raw)
+        if value is None:
+            missing.append(key)
+            count("fields_unrecoverable")
+            continue
+        if value != raw:
+            count("fields_coerced")
+            logging.info(f"Coerced reflection field '{key}' from {type(raw).__name__} to schema type.")
+        clean[key] = value
+    if keys is None:
+        # Only the first pass: re-validating a follow-up would count the same fields again.
+        # What the follow-up still couldn't fill is counted by the caller as fields_defaulted.
+        count("fields_missing", len(missing))
+    return clean, missing
+
+
+def build_followup_prompt(transcript: str, missing_keys: list) -> str:
+    """Prompt asking ONLY for the missing keys, so the follow-up request stays small."""
+    field_lines = "\n".join(f'- "{k}": {FIELD_INSTRUCTIONS[k]}' for k in missing_keys)
+    return f"""
+        Analyze the following conversation transcript(s) from a day captured by the Omi device.
+        Return ONLY a valid JSON object containing exactly these keys:
+{field_lines}
+
+        Transcript(s):
+        "{transcript}"
+    """
+
+
+def log_counters():
+    """Emits this response's counter increments as one structured log line and resets them."""
+    counts = getattr(_local_counters, "counts", None) or Counter()
+    _local_counters.counts = Counter()
+    logging.info(json.dumps({"metric": "reflection_schema_counters", **counts}))
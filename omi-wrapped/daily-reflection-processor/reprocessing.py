@@ -0,0 +1,235 @@
+import os
+import time
+import uuid
+import logging
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import firestore
+
+# --- Checkpointed Reprocessing Across History ---
+# Regenerates reflections after a prompt/model change, for a set of users and a date range.
+#   plan: enumerate user-days that have raw data and whose reflection isn't already at the target
+#         version; store them as reprocessing_runs/{run_id}/items/{uid}_{date} (status "pending")
+#   run:  process pending items with bounded parallelism until the time budget is spent; each item
+#         is claimed (pending -> running, with a lease) in a transaction before processing and
+#         checkpointed individually, so an interrupted run resumes exactly where it stopped and
+#         overlapping invocations never process the same item.
+# Reprocessing runs at lower priority than live nightly processing: while the end-of-day
+# scheduler holds the live-processing lease, workers stop picking up new items.
+
+RUNS_COLLECTION = "reprocessing_runs"
+ITEMS_SUBCOLLECTION = "items"
+SYSTEM_STATE_COLLECTION = "system_state"
+LIVE_PROCESSING_DOC = "live_processing"
+REPROCESS_MAX_WORKERS = int(os.environ.get("REPROCESS_MAX_WORKERS", "4"))
+# Stay well inside the Cloud Function timeout; the next invocation continues the run
+REPROCESS_TIME_BUDGET_SECONDS = int(os.environ.get("REPROCESS_TIME_BUDGET_SECONDS", "420"))
+REPROCESS_MAX_ATTEMPTS = 3
+# An item is leased while a worker processes it; a crashed invocation's leases expire after this
+ITEM_LEASE_SECONDS = int(os.environ.get("REPROCESS_ITEM_LEASE_SECONDS", "900"))
+LIVE_LEASE_SECONDS = 15 * 60
+
+
+# --- Live-Processing Lease (priority) ---
+
+def acquire_live_lease(firestore_client, holder_id: str, seconds: int = LIVE_LEASE_SECONDS):
+    """
+    Marks live processing as active for one scheduler tick; reprocessing yields while any tick's
+    lease is unexpired. Each tick holds its own entry (holders.{holder_id}), so overlapping ticks
+    don't release each other's lease. Expired entries left by crashed ticks are pruned here.
+    """
+    now = datetime.now(timezone.utc)
+    lease_ref = firestore_client.collection(SYSTEM_STATE_COLLECTION).document(LIVE_PROCESSING_DOC)
+    snapshot = lease_ref.get()
+    holders = ((snapshot.to_dict() or {}).get("holders") or {}) if snapshot.exists else {}
+    update = {"holders": {h: firestore.DELETE_FIELD for h, until in holders.items() if not until or until <= now}}
+    update["holders"][holder_id] = now + timedelta(seconds=seconds)
+    lease_ref.set(update, merge=True)
+
+
+def release_live_lease(firestore_client, holder_id: str):
+    lease_ref = firestore_client.collection(SYSTEM_STATE_COLLECTION).document(LIVE_PROCESSING_DOC)
+    lease_ref.set({"holders": {holder_id: firestore.DELETE_FIELD}}, merge=True)
+
+
+def live_processing_active(firestore_client) -> bool:
+    snapshot = firestore_client.collection(SYSTEM_STATE_COLLECTION).document(LIVE_PROCESSING_DOC).get()
+    holders = ((snapshot.to_dict() or {}).get("holders") or {}) if snapshot.exists else {}
+    now = datetime.now(timezone.utc)
+    return any(until and until > now for until in holders.values())
+
+
+# --- Planning ---
+
+def _dates_between(start: str, end: str) -> list:
+    day = datetime.strptime(start, "%Y-%m-%d").date()
+    last = datetime.strptime(end, "%Y-%m-%d").date()
+    if last < day:
+        raise ValueError("end date is before start date")
+    dates = []
+    while day <= last:
+        dates.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+    return dates
+
+
+def users_with_raw_data(firestore_client, start: str, end: str) -> list:
+    """UIDs with a raw_memories document dated in [start, end], taken from the {uid}_{date} IDs.
+    Reads IDs only (empty field mask); used for uids=all, where history predates user_settings."""
+    user_ids = set()
+    for snapshot in firestore_client.collection("raw_memories").select([]).stream():
+        uid, _, date_str = snapshot.id.rpartition("_")
+        if uid and start <= date_str <= end:
+            user_ids.add(uid)
+    return sorted(user_ids)
+
+
+def plan_run(firestore_client, user_ids: list, start: str, end: str, prompt_version: str, model: str) -> tuple:
+    """Creates a run with one pending item per user-day that needs regenerating. Returns (run_id, item_count)."""
+    dates = _dates_between(start, end)
+    run_ref = firestore_client.collection(RUNS_COLLECTION).document()
+    raw_coll = firestore_client.collection("raw_memories")
+    reflections_coll = firestore_client.collection("daily_reflections")
+
+    item_count, skipped_current = 0, 0
+    batch, batch_size = firestore_client.batch(), 0
+    for user_id in user_ids:
+        doc_ids = [f"{user_id}_{d}" for d in dates]
+        # Field masks keep these existence/version checks cheap (no transcripts transferred)
+        has_raw = {s.id for s in firestore_client.get_all([raw_coll.document(d) for d in doc_ids], field_paths=["storage_tier"]) if s.exists}
+        versions = {
+            s.id: ((s.to_dict() or {}).get("prompt_version"), (s.to_dict() or {}).get("model"))
+            for s in firestore_client.get_all([reflections_coll.document(d) for d in has_raw], field_paths=["prompt_version", "model"])
+        } if has_raw else {}
+
+        for doc_id in doc_ids:
+            if doc_id not in has_raw:
+                continue
+            if versions.get(doc_id) == (prompt_version, model):
+                skipped_current += 1
+                continue
+            batch.set(run_ref.collection(ITEMS_SUBCOLLECTION).document(doc_id), {
+                "uid": user_id, "date": doc_id.rsplit("_", 1)[1], "status": "pending", "attempts": 0,
+            })
+            item_count += 1
+            batch_size += 1
+            if batch_size == 500: # Firestore batch limit
+                batch.commit()
+                batch, batch_size = firestore_client.batch(), 0
+    if batch_size:
+        batch.commit()
+
+    run_ref.set({
+        "state": "planned" if item_count else "completed",
+        "prompt_version": prompt_version,
+        "model": model,
+        "start": start,
+        "end": end,
+        "user_count": len(user_ids),
+        "total": item_count,
+        "done": 0,
+        "failed": 0,
+        "skipped_current": skipped_current,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    })
+    logging.info(f"Planned reprocessing run {run_ref.id}: {item_count} user-days ({skipped_current} already current)")
+    return run_ref.id, item_count
+
+
+# --- Execution ---
+
+@firestore.transactional
+def _claim_item(transaction, item_ref, run_token: str):
+    """Moves an item from pending (or running with an expired lease) to running, leased to this
+    invocation. Returns the item, or None if another invocation got it first."""
+    snapshot = item_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    item = snapshot.to_dict()
+    now = datetime.now(timezone.utc)
+    lease_until = item.get("lease_until")
+    if item.get("status") == "running" and lease_until and lease_until > now:
+        return None
+    if item.get("status") not in ("pending", "running"):
+        return None
+    transaction.update(item_ref, {
+        "status": "running", "claimed_by": run_token,
+        "lease_until": now + timedelta(seconds=ITEM_LEASE_SECONDS),
+    })
+    return item
+
+
+def _claimable_items(items_coll, limit: int) -> list:
+    """Pending items, plus running ones whose lease expired (their invocation died mid-item)."""
+    refs = [s.reference for s in items_coll.where("status", "==", "pending").limit(limit).stream()]
+    if len(refs) < limit:
+        stale = items_coll.where("status", "==", "running").where("lease_until", "<", datetime.now(timezone.utc)).limit(limit - len(refs))
+        refs.extend(s.reference for s in stale.stream())
+    return refs
+
+
+def run_pending(firestore_client, run_id: str, process_fn) -> dict:
+    """
+    Processes the run's pending items with up to REPROCESS_MAX_WORKERS in parallel until the time
+    budget is spent, no items remain, or live processing takes priority.
+    process_fn(uid, date, prompt_version, model) -> (message, http_status).
+    """
+    run_ref = firestore_client.collection(RUNS_COLLECTION).document(run_id)
+    run_snapshot = run_ref.get()
+    if not run_snapshot.exists:
+        raise KeyError(run_id)
+    run = run_snapshot.to_dict()
+    if run.get("state") == "completed":
+        return {"state": "completed", "processed": 0, "failed": 0}
+
+    deadline = time.monotonic() + REPROCESS_TIME_BUDGET_SECONDS
+    items_coll = run_ref.collection(ITEMS_SUBCOLLECTION)
+    summary = {"processed": 0, "failed": 0, "claimed_elsewhere": 0, "yielded_to_live": False}
+    run_ref.update({"state": "running", "updated_at": firestore.SERVER_TIMESTAMP})
+
+    run_token = uuid.uuid4().hex
+
+    def work(item_ref):
+        # Claim first: a wave can outlive the time budget, and the next scheduled invocation must
+        # not process (and bill) the same items concurrently
+        item = _claim_item(firestore_client.transaction(), item_ref, run_token)
+        if item is None:
+            return None
+        message, status = process_fn(item["uid"], item["date"], run["prompt_version"], run["model"])
+        attempts = item.get("attempts", 0) + 1
+        release = {"claimed_by": firestore.DELETE_FIELD, "lease_until": firestore.DELETE_FIELD}
+        if status == 200:
+            item_ref.update({"status": "done", "attempts": attempts, "finished_at": firestore.SERVER_TIMESTAMP, **release})
+            run_ref.update({"done": firestore.Increment(1), "updated_at": firestore.SERVER_TIMESTAMP})
+            return True
+        # Back to pending for a later wave/invocation, until attempts are exhausted
+        final = attempts >= REPROCESS_MAX_ATTEMPTS
+        item_ref.update({"status": "failed" if final else "pending", "attempts": attempts, "last_error": message, **release})
+        if final:
+            run_ref.update({"failed": firestore.Increment(1), "updated_at": firestore.SERVER_TIMESTAMP})
+        return False
+
+    with ThreadPoolExecutor(max_workers=REPROCESS_MAX_WORKERS) as pool:
+        while time.monotonic() < deadline:
+            if live_processing_active(firestore_client):
+                logging.info(f"Reprocessing run {run_id} yielding to live processing.")
+                summary["yielded_to_live"] = True
+                break
+            # One "wave" of items per worker; re-check priority and deadline between waves
+            wave = _claimable_items(items_coll, REPROCESS_MAX_WORKERS)
+            if not wave:
+                break
+            for ok in pool.map(work, wave):
+                if ok is None:
+                    summary["claimed_elsewhere"] += 1
+                else:
+                    summary["processed" if ok else "failed"] += 1
+
+    # Items another invocation is still working on keep the run open
+    remaining = len(list(items_coll.where("status", "in", ["pending", "running"]).limit(1).stream()))
+    state = "running" if remaining else "completed"
+    run_ref.update({"state": state, "updated_at": firestore.SERVER_TIMESTAMP})
+    summary["state"] = state
+    logging.info(f"Reprocessing run {run_id}: {summary}")
+    return summary
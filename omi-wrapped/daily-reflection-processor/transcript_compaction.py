@@ -0,0 +1,220 @@
+import re
+import math
+from collections import Counter
+
+# --- Transcript Compaction ---
+# Omi ASR output is full of fillers ("um", "you know"), stutters ("I I I think"), repeated
+# phrases and near-duplicate segments (the same conversation captured twice). All of it is
+# billed as prompt tokens. This module shrinks the day's transcript deterministically
+# (same input -> same output) BEFORE it is sent to OpenAI. The output schema is untouched.
+
+# Single-word fillers / disfluencies, removed wherever they appear as a whole word
+FILLER_WORDS = {"um", "umm", "uh", "uhh", "uhm", "er", "erm", "ah", "hmm", "hm", "mm", "mhm", "eh"}
+# Discourse fillers, only removed when set off by a comma ("you know, ..."). Without the comma
+# they usually carry meaning ("do you know him"). "like" is left alone even with a comma:
+# "the things I like, such as pizza" is a verb, not a filler.
+FILLER_PHRASES = ["you know what i mean", "you know", "i mean", "basically", "actually", "literally"]
+
+_FILLER_WORD_RE = re.compile(r"\b(?:" + "|".join(sorted(FILLER_WORDS, key=len, reverse=True)) + r")\b,?\s*", re.IGNORECASE)
+_FILLER_PHRASE_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(p) for p in FILLER_PHRASES) + r"),\s*",
+    re.IGNORECASE,
+)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+# Segments whose shingle sets overlap at least this much are treated as duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+# Longest phrase (in words) checked for immediate repetition ("we should we should")
+MAX_REPEAT_NGRAM = 6
+# Unpunctuated ASR output can be one huge "sentence"; longer ones are ranked as word chunks of this size
+MAX_SENTENCE_TOKENS = 100
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token for English), good enough for budgets and reporting."""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def remove_fillers(text: str) -> str:
+    """Drops filler words/phrases and tidies the whitespace they leave behind."""
+    text = _FILLER_PHRASE_RE.sub("", text)
+    text = _FILLER_WORD_RE.sub("", text)
+    text = re.sub(r"\s+([,.!?])", r"\1", text)
+    text = re.sub(r"([,.!?])(?:\s*[,.])+", r"\1", text)
+    return re.sub(r"\s{2,}", " ", text).strip()
+
+
+def _normalize_word(word: str) -> str:
+    return word.lower().strip(",.!?;:\"'")
+
+
+def _collapse_once(words: list, max_n: int) -> list:
+    out = []
+    i = 0
+    while i < len(words):
+        collapsed = False
+        # Shortest period first, so "no no no no" collapses to "no" rather than "no no"
+        for n in range(1, min(max_n, (len(words) - i) // 2) + 1):
+            phrase = [_normalize_word(w) for w in words[i:i + n]]
+            j = i + n
+            repeats = 0
+            while j + n <= len(words) and [_normalize_word(w) for w in words[j:j + n]] == phrase:
+                j += n
+                repeats += 1
+            if repeats:
+                # Keep the last occurrence so trailing punctuation is preserved
+                out.extend(words[j - n:j])
+                i = j
+                collapsed = True
+                break
+        if not collapsed:
+            out.append(words[i])
+            i += 1
+    return out
+
+
+def collapse_repeated_ngrams(text: str, max_n: int = MAX_REPEAT_NGRAM) -> str:
+    """Collapses immediately repeated n-grams ("I I I think" -> "I think", "we should we should go" -> "we should go")."""
+    words = text.split()
+    if len(words) < 2:
+        return text
+
+    # Collapsing can expose a new repeat ("we we should we should" -> "we should we should"), so repeat until stable
+    while True:
+        collapsed = _collapse_once(words, max_n)
+        if len(collapsed) == len(words):
+            return " ".join(collapsed)
+        words = collapsed
+
+
+def _shingles(text: str, k: int = SHINGLE_SIZE) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def remove_near_duplicates(segments: list, threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list:
+    """Drops segments whose word-shingle sets are >= threshold similar to an earlier kept segment.
+    Also drops segments almost fully contained in a longer kept one (a re-captured excerpt)."""
+    kept, kept_shingles = [], []
+    for segment in segments:
+        shingles = _shingles(segment)
+        if not shingles:
+            continue
+        is_duplicate = False
+        for other in kept_shingles:
+            overlap = len(shingles & other)
+            if _jaccard(shingles, other) >= threshold or overlap / len(shingles) >= threshold:
+                is_duplicate = True
+                break
+        if not is_duplicate:
+            kept.append(segment)
+            kept_shingles.append(shingles)
+    return kept
+
+
+def split_sentences(text: str) -> list:
+    return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text) if s.strip()]
+
+
+def _chunk_long_sentence(sentence: str, max_tokens: int = MAX_SENTENCE_TOKENS) -> list:
+    """Splits a sentence longer than max_tokens into consecutive word chunks."""
+    if estimate_tokens(sentence) <= max_tokens:
+        return [sentence]
+    chunks, current = [], []
+    for word in sentence.split():
+        if current and estimate_tokens(" ".join(current + [word])) > max_tokens:
+            chunks.append(" ".join(current))
+            current = []
+        current.append(word)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    words, out = text.split(), []
+    for word in words:
+        if estimate_tokens(" ".join(out + [word])) > max_tokens:
+            break
+        out.append(word)
+    return " ".join(out)
+
+
+def trim_to_token_budget(segments: list, token_budget: int) -> list:
+    """
+    Extractive trimming: if the segments exceed token_budget, keep the highest-scoring sentences
+    (by average document-level word frequency, ignoring very short words) in their ORIGINAL order.
+    Each segment keeps its own sentences so conversation boundaries survive. Sentences longer
+    than MAX_SENTENCE_TOKENS are ranked as word chunks, so unpunctuated transcripts still fit.
+    """
+    total = sum(estimate_tokens(s) for s in segments)
+    if token_budget <= 0 or total <= token_budget:
+        return segments
+
+    sentences = []  # (segment_index, sentence_index, sentence)
+    for seg_idx, segment in enumerate(segments):
+        chunks = [c for sentence in split_sentences(segment) for c in _chunk_long_sentence(sentence)]
+        for sent_idx, sentence in enumerate(chunks):
+            sentences.append((seg_idx, sent_idx, sentence))
+
+    freq = Counter(w for _, _, s in sentences for w in _WORD_RE.findall(s.lower()) if len(w) > 3)
+
+    def score(sentence: str) -> float:
+        words = [w for w in _WORD_RE.findall(sentence.lower()) if len(w) > 3]
+        return sum(freq[w] for w in words) / len(words) if words else 0.0
+
+    # Deterministic ranking: score desc, then original position
+    ranked = sorted(range(len(sentences)), key=lambda i: (-score(sentences[i][2]), i))
+    chosen, used = set(), 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i][2]) + 1
+        if used + cost > token_budget:
+            continue
+        chosen.add(i)
+        used += cost
+
+    trimmed = {}
+    if not chosen and ranked:
+        # Budget smaller than any chunk: never return nothing, keep the top-ranked content cut to fit
+        _, _, sentence = sentences[ranked[0]]
+        return [_truncate_to_tokens(sentence, token_budget) or sentence[:token_budget * 4]]
+    for i in sorted(chosen):
+        seg_idx, _, sentence = sentences[i]
+        trimmed.setdefault(seg_idx, []).append(sentence)
+    return [" ".join(trimmed[k]) for k in sorted(trimmed)]
+
+
+def compact_transcripts(transcripts: list, token_budget: int = 0) -> tuple:
+    """
+    Runs the full compaction pipeline over a day's per-memory transcripts.
+    Returns (compacted_segments, stats) where stats has tokens/chars before and after.
+    token_budget <= 0 disables extractive trimming.
+    """
+    original = [t for t in transcripts if t]
+    tokens_before = sum(estimate_tokens(t) for t in original)
+    chars_before = sum(len(t) for t in original)
+
+    cleaned = [collapse_repeated_ngrams(remove_fillers(t)) for t in original]
+    cleaned = [c for c in cleaned if c]
+    deduped = remove_near_duplicates(cleaned)
+    segments = trim_to_token_budget(deduped, token_budget)
+
+    stats = {
+        "segments_before": len(original),
+        "segments_after": len(segments),
+        "chars_before": chars_before,
+        "chars_after": sum(len(s) for s in segments),
+        "tokens_before": tokens_before,
+        "tokens_after": sum(estimate_tokens(s) for s in segments),
+    }
+    return segments, stats
@@ -0,0 +1,55 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+import pytz
+
+# --- Per-User Timezone Registry ---
+# Mirrors omi-webhook-collector/user_timezones.py: both services MUST resolve the
+# {uid}_{YYYY-MM-DD} date part from the same registry, or the processor reads the wrong doc.
+# Registry document: user_settings/{uid} -> {"timezone": "Area/City", "last_processed_date": "YYYY-MM-DD"}
+
+USER_SETTINGS_COLLECTION = "user_settings"
+# Fallback keeps the historical behaviour (the job used to be hard-coded to Pacific Time)
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "America/Los_Angeles")
+CACHE_TTL_SECONDS = int(os.environ.get("TIMEZONE_CACHE_TTL_SECONDS", "600"))
+
+_timezone_cache = {}  # uid -> (timezone_name, expires_at)
+
+
+def is_valid_timezone(tz_name: str) -> bool:
+    """Returns True if tz_name is a known IANA timezone name."""
+    return bool(tz_name) and tz_name in pytz.all_timezones_set
+
+
+def timezone_from_settings(settings: dict) -> str:
+    """Extracts a valid timezone name from a user_settings dict, or DEFAULT_TIMEZONE."""
+    registered = (settings or {}).get("timezone")
+    return registered if is_valid_timezone(registered) else DEFAULT_TIMEZONE
+
+
+def get_user_timezone_name(firestore_client, uid: str) -> str:
+    """Looks up the user's registered timezone, falling back to DEFAULT_TIMEZONE."""
+    cached = _timezone_cache.get(uid)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    tz_name = DEFAULT_TIMEZONE
+    if firestore_client is not None:
+        try:
+            snapshot = firestore_client.collection(USER_SETTINGS_COLLECTION).document(uid).get()
+            if snapshot.exists:
+                tz_name = timezone_from_settings(snapshot.to_dict())
+        except Exception as e:
+            logging.error(f"Error reading timezone for UID {uid}: {e}. Using default {DEFAULT_TIMEZONE}.")
+            return tz_name
+
+    _timezone_cache[uid] = (tz_name, time.monotonic() + CACHE_TTL_SECONDS)
+    return tz_name
+
+
+def local_date_str(event_dt: datetime, tz_name: str) -> str:
+    """Converts an aware (or naive UTC) datetime to the YYYY-MM-DD date in tz_name."""
+    if event_dt.tzinfo is None:
+        event_dt = event_dt.replace(tzinfo=timezone.utc)
+    return event_dt.astimezone(pytz.timezone(tz_name)).strftime('%Y-%m-%d')
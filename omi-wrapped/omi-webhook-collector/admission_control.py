@@ -0,0 +1,125 @@
+import os
+import math
+import time
+from collections import OrderedDict
+
+# --- Admission Control & Backpressure for /memory_webhook ---
+# A misbehaving device or a retry storm must not be able to queue unbounded background work
+# or hammer one {uid}_{date} document. Requests are admitted only if:
+#   1. the per-uid token bucket AND the global token bucket both have a token, and
+#   2. fewer than MAX_IN_FLIGHT background saves are queued/running.
+# Otherwise the caller gets 429 with a Retry-After hint. Limits are per server process
+# (the Dockerfile runs 2 uvicorn workers), which is what bounds each instance's memory.
+
+PER_UID_RATE = float(os.environ.get("WEBHOOK_PER_UID_RATE", "2")) # tokens/second
+PER_UID_BURST = float(os.environ.get("WEBHOOK_PER_UID_BURST", "20"))
+GLOBAL_RATE = float(os.environ.get("WEBHOOK_GLOBAL_RATE", "200"))
+GLOBAL_BURST = float(os.environ.get("WEBHOOK_GLOBAL_BURST", "400"))
+MAX_IN_FLIGHT = int(os.environ.get("WEBHOOK_MAX_IN_FLIGHT", "500"))
+MAX_PAYLOAD_BYTES = int(os.environ.get("WEBHOOK_MAX_PAYLOAD_BYTES", str(2 * 1024 * 1024)))
+# Bound the bucket table itself; least recently seen uids are evicted (a fresh bucket is full anyway)
+MAX_TRACKED_UIDS = int(os.environ.get("WEBHOOK_MAX_TRACKED_UIDS", "10000"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def seconds_until_token(self) -> float:
+        self._refill()
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Single-process admission state. All methods are called from the event loop thread."""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.uid_buckets = OrderedDict()
+        self.in_flight = 0
+        self.rejected = {"uid_rate": 0, "global_rate": 0, "in_flight": 0, "payload_too_large": 0}
+        self.admitted = 0
+
+    def _uid_bucket(self, uid: str) -> TokenBucket:
+        bucket = self.uid_buckets.get(uid)
+        if bucket is None:
+            bucket = TokenBucket(PER_UID_RATE, PER_UID_BURST)
+            self.uid_buckets[uid] = bucket
+            if len(self.uid_buckets) > MAX_TRACKED_UIDS:
+                self.uid_buckets.popitem(last=False)
+        else:
+            self.uid_buckets.move_to_end(uid)
+        return bucket
+
+    def admit(self, uid: str):
+        """Returns (None, None) if admitted, otherwise (reason, retry_after_seconds)."""
+        if self.in_flight >= MAX_IN_FLIGHT:
+            self.rejected["in_flight"] += 1
+            # No precise signal for when work drains; suggest a short backoff
+            return "in_flight", 1
+
+        uid_bucket = self._uid_bucket(uid)
+        if not uid_bucket.try_acquire():
+            self.rejected["uid_rate"] += 1
+            return "uid_rate", max(1, math.ceil(uid_bucket.seconds_until_token()))
+        if not self.global_bucket.try_acquire():
+            uid_bucket.refund() # Don't charge the user for a global rejection
+            self.rejected["global_rate"] += 1
+            return "global_rate", max(1, math.ceil(self.global_bucket.seconds_until_token()))
+
+        self.admitted += 1
+        return None, None
+
+    def task_started(self):
+        self.in_flight += 1
+
+    def task_finished(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": MAX_IN_FLIGHT,
+            "utilization": round(self.in_flight / MAX_IN_FLIGHT, 3) if MAX_IN_FLIGHT else 0.0,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "tracked_uids": len(self.uid_buckets),
+        }
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+async def read_body_limited(request, max_bytes: int = MAX_PAYLOAD_BYTES) -> bytes:
+    """Reads the request body, aborting as soon as it exceeds max_bytes (never buffers more)."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise PayloadTooLarge()
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise PayloadTooLarge()
+        chunks.append(chunk)
+    return b"".join(chunks)
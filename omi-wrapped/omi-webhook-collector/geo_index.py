@@ -0,0 +1,251 @@
+import math
+import logging
+from collections import Counter
+from datetime import datetime
+import numpy as np
+
+# --- Geospatial Index over Memory Geolocation ---
+# Every memory with a geolocation gets one point document, keyed by memory_id:
+#   geo_index/{uid}/points/{memory_id} -> {geohash, latitude, longitude, address, day_doc_id, ...}
+# Geohashes sort lexicographically by area, so "all points in this cell" is a single range
+# query on the `geohash` field. Radius and bounding-box queries cover the area with a handful
+# of cells, range-query each one and filter the (few) candidates exactly.
+
+GEO_INDEX_COLLECTION = "geo_index"
+POINTS_SUBCOLLECTION = "points"
+GEOHASH_PRECISION = 9 # ~5m cells, stored on every point; queries use shorter prefixes
+MAX_COVER_CELLS = 16 # Upper bound on range queries per radius/bbox lookup
+PLACE_RADIUS_M = 150.0 # Points closer than this (transitively) belong to the same place
+TRANSCRIPT_PREVIEW_CHARS = 200
+EARTH_RADIUS_M = 6_371_000.0
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Approximate cell size in degrees (lat, lng) per geohash precision
+_CELL_DEGREES = {p: (180.0 / 2 ** ((5 * p) // 2), 360.0 / 2 ** ((5 * p + 1) // 2)) for p in range(1, 13)}
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits <<= 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(chars)
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters. Works on scalars or NumPy arrays."""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def cover_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> list:
+    """Returns the geohash prefixes (at the finest precision needing <= MAX_COVER_CELLS cells) covering the box."""
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        cell_lat, cell_lng = _CELL_DEGREES[precision]
+        rows = math.floor(max_lat / cell_lat) - math.floor(min_lat / cell_lat) + 1
+        cols = math.floor(max_lng / cell_lng) - math.floor(min_lng / cell_lng) + 1
+        if rows * cols > MAX_COVER_CELLS:
+            continue
+        cells = set()
+        for r in range(rows):
+            for c in range(cols):
+                lat = min(min_lat + r * cell_lat, max_lat)
+                lng = min(min_lng + c * cell_lng, max_lng)
+                cells.add(encode_geohash(lat, lng, precision))
+        return sorted(cells)
+    return [""] # Whole world
+
+
+def _points(firestore_client, uid: str):
+    return firestore_client.collection(GEO_INDEX_COLLECTION).document(uid).collection(POINTS_SUBCOLLECTION)
+
+
+def extract_lat_lng(geolocation):
+    """Returns (lat, lng) from an Omi geolocation map, or None if it has no usable coordinates."""
+    if not isinstance(geolocation, dict):
+        return None
+    try:
+        lat, lng = float(geolocation["latitude"]), float(geolocation["longitude"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+def index_memory(firestore_client, uid: str, day_doc_id: str, memory_entry: dict) -> bool:
+    """Adds one memory to the user's geo index (called on the collector's save path).
+    Returns False if the memory has no usable geolocation."""
+    geolocation = memory_entry.get("geolocation")
+    coords = extract_lat_lng(geolocation)
+    if coords is None:
+        return False
+
+    started, finished = memory_entry.get("started_at"), memory_entry.get("finished_at")
+    duration = (finished - started).total_seconds() if isinstance(started, datetime) and isinstance(finished, datetime) else 0.0
+
+    _points(firestore_client, uid).document(memory_entry["memory_id"]).set({
+        "geohash": encode_geohash(*coords),
+        "latitude": coords[0],
+        "longitude": coords[1],
+        "address": geolocation.get("address"),
+        "memory_id": memory_entry["memory_id"],
+        "day_doc_id": day_doc_id,
+        "started_at": started,
+        "finished_at": finished,
+        "duration_seconds": max(duration, 0.0),
+        "transcript_preview": (memory_entry.get("transcript") or "")[:TRANSCRIPT_PREVIEW_CHARS],
+    })
+    return True
+
+
+def query_bbox(firestore_client, uid: str, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> list:
+    """All indexed points for the user inside the bounding box."""
+    results = {}
+    for prefix in cover_bbox(min_lat, min_lng, max_lat, max_lng):
+        query = _points(firestore_client, uid)
+        if prefix:
+            # "~" sorts after every base32 character, so this is "starts with prefix"
+            query = query.where("geohash", ">=", prefix).where("geohash", "<", prefix + "~")
+        for snap in query.stream():
+            point = snap.to_dict()
+            if min_lat <= point["latitude"] <= max_lat and min_lng <= point["longitude"] <= max_lng:
+                results[snap.id] = point
+    return list(results.values())
+
+
+def query_radius(firestore_client, uid: str, latitude: float, longitude: float, radius_m: float) -> list:
+    """All indexed points within radius_m of (latitude, longitude), nearest first, with `distance_m`."""
+    d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+    d_lng = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+    candidates = query_bbox(
+        firestore_client, uid,
+        max(latitude - d_lat, -90.0), max(longitude - d_lng, -180.0),
+        min(latitude + d_lat, 90.0), min(longitude + d_lng, 180.0),
+    )
+    results = []
+    for point in candidates:
+        distance = float(haversine_m(latitude, longitude, point["latitude"], point["longitude"]))
+        if distance <= radius_m:
+            results.append({**point, "distance_m": round(distance, 1)})
+    return sorted(results, key=lambda p: p["distance_m"])
+
+
+def _link_neighbouring_cells(grid: np.ndarray, cell_lat: np.ndarray, cell_lng: np.ndarray, reach: int, radius_m: float) -> np.ndarray:
+    """
+    Component label per cell, linking cells whose centroids are within radius_m. Only cells at most
+    `reach` grid steps apart can be that close, so candidate pairs are found per grid offset with a
+    sorted-key lookup (O(n_cells log n_cells) per offset) and merged with union-find.
+    """
+    n_cells = len(grid)
+    span = int(grid[:, 1].max() - grid[:, 1].min()) + 2 * reach + 1
+    keys = (grid[:, 0] - grid[:, 0].min() + reach) * span + (grid[:, 1] - grid[:, 1].min() + reach)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+
+    parent = list(range(n_cells))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for dx in range(0, reach + 1):
+        for dy in range(-reach, reach + 1):
+            if dx == 0 and dy <= 0:
+                continue # Each unordered pair of offsets once; a cell is trivially linked to itself
+            target = keys + dx * span + dy
+            pos = np.minimum(np.searchsorted(sorted_keys, target), n_cells - 1)
+            found = sorted_keys[pos] == target
+            a = np.flatnonzero(found)
+            b = order[pos[found]]
+            close = haversine_m(cell_lat[a], cell_lng[a], cell_lat[b], cell_lng[b]) <= radius_m
+            for i, j in zip(a[close].tolist(), b[close].tolist()):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(n_cells)])
+
+
+def cluster_places(points: list, radius_m: float = PLACE_RADIUS_M) -> list:
+    """
+    Turns raw points into named places with visit counts and talk time. Vectorized:
+      1. snap points to a grid of radius_m/2 cells (np.unique), so dense histories collapse
+         to the few distinct cells actually visited;
+      2. link neighbouring cells whose weighted centroids are within radius_m, and label
+         connected components with union-find (linear in the number of cells);
+      3. aggregate per component with np.bincount.
+    CPU-bound: call it off the event loop.
+    """
+    if radius_m <= 0:
+        raise ValueError("radius_m must be positive")
+    if not points:
+        return []
+    lat = np.array([p["latitude"] for p in points], dtype=np.float64)
+    lng = np.array([p["longitude"] for p in points], dtype=np.float64)
+    duration = np.array([p.get("duration_seconds") or 0.0 for p in points], dtype=np.float64)
+
+    # 1. Local metric projection (equirectangular) and grid snapping
+    y = np.radians(lat) * EARTH_RADIUS_M
+    x = np.radians(lng) * EARTH_RADIUS_M * np.cos(np.radians(lat))
+    cell_size = radius_m / 2
+    grid = np.stack([np.floor(x / cell_size), np.floor(y / cell_size)], axis=1).astype(np.int64)
+    cells, point_cell = np.unique(grid, axis=0, return_inverse=True)
+    point_cell = point_cell.reshape(-1)
+    n_cells = len(cells)
+    cell_weight = np.bincount(point_cell, minlength=n_cells)
+    cell_lat = np.bincount(point_cell, weights=lat, minlength=n_cells) / cell_weight
+    cell_lng = np.bincount(point_cell, weights=lng, minlength=n_cells) / cell_weight
+
+    # 2. Connected components over cells within radius_m of each other. Centroids lie inside
+    # their cells, so linked cells are at most radius_m / cell_size + 1 = 3 steps apart
+    labels = _link_neighbouring_cells(cells, cell_lat, cell_lng, int(math.ceil(radius_m / cell_size)) + 1, radius_m)
+    _, cell_cluster = np.unique(labels, return_inverse=True)
+    point_cluster = cell_cluster.reshape(-1)[point_cell]
+
+    # 3. Aggregate per place
+    n_clusters = point_cluster.max() + 1
+    counts = np.bincount(point_cluster, minlength=n_clusters)
+    talk_time = np.bincount(point_cluster, weights=duration, minlength=n_clusters)
+    centroid_lat = np.bincount(point_cluster, weights=lat, minlength=n_clusters) / counts
+    centroid_lng = np.bincount(point_cluster, weights=lng, minlength=n_clusters) / counts
+
+    places = []
+    for cluster in range(n_clusters):
+        members = [points[i] for i in np.flatnonzero(point_cluster == cluster)]
+        addresses = Counter(p["address"] for p in members if p.get("address"))
+        days = {p["day_doc_id"] for p in members if p.get("day_doc_id")}
+        name = addresses.most_common(1)[0][0] if addresses else f"Place near {centroid_lat[cluster]:.4f}, {centroid_lng[cluster]:.4f}"
+        places.append({
+            "name": name,
+            "latitude": float(centroid_lat[cluster]),
+            "longitude": float(centroid_lng[cluster]),
+            "geohash": encode_geohash(centroid_lat[cluster], centroid_lng[cluster], 7),
+            "memory_count": int(counts[cluster]),
+            "visit_count": len(days) or int(counts[cluster]), # distinct days at the place
+            "talk_time_seconds": round(float(talk_time[cluster]), 1),
+            "memory_ids": [p["memory_id"] for p in members],
+        })
+    places.sort(key=lambda p: (-p["talk_time_seconds"], -p["memory_count"]))
+    logging.info(f"Clustered {len(points)} points into {len(places)} places ({n_cells} grid cells).")
+    return places
+
+
+def load_points_between(firestore_client, uid: str, start: datetime, end: datetime) -> list:
+    """All of the user's indexed points whose memory finished in [start, end)."""
+    query = _points(firestore_client, uid).where("finished_at", ">=", start).where("finished_at", "<", end)
+    return [snap.to_dict() for snap in query.stream()]
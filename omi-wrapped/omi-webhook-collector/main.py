@@ -1,11 +1,19 @@
 import os
 import logging
 import json
-from datetime import datetime, timezone # Use timezone-aware datetimes
+import asyncio
+from datetime import datetime, timezone, timedelta # Use timezone-aware datetimes
+import pytz
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from google.cloud import firestore # Import Firestore
-from google.api_core.exceptions import GoogleAPICallError # For Firestore error handling
+from google.api_core.exceptions import GoogleAPICallError, NotFound # For Firestore error handling
+import user_timezones # Per-user timezone registry for {uid}_{date} keys
+import geo_index # Geohash index + place clustering over memory geolocation
+import admission_control # Token-bucket admission + bounded background work for /memory_webhook
+import reflection_pubsub # Pluggable pub/sub for "reflection ready" push events
 
 # --- Configuration & Logging ---
 # No .env needed here IF running on Cloud Run with service account permissions
@@ -32,6 +40,21 @@ app.add_middleware(
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
 )
 
+# --- Reflection Events (SSE push) ---
+pubsub = reflection_pubsub.create_pubsub()
+SSE_HEARTBEAT_SECONDS = 15
+
+@app.on_event("startup")
+async def start_reflection_events():
+    pubsub.start(asyncio.get_running_loop(), firestore_client if firestore_available else None)
+
+@app.on_event("shutdown")
+async def stop_reflection_events():
+    pubsub.stop()
+
+# --- Admission Control ---
+admission = admission_control.AdmissionController()
+
 # --- Background Task Function for Firestore ---
 async def save_to_firestore_background(uid: str, memory_data: dict):
     """Saves the extracted memory data to Firestore in the background."""
@@ -49,8 +72,8 @@ async def save_to_firestore_background(uid: str, memory_data: dict):
         else:
             event_dt = datetime.now(timezone.utc)
 
-        date_str = event_dt.strftime('%Y-%m-%d')
-        doc_id = f"{uid}_{date_str}"
+        # Bucket by the user's LOCAL date so the processor finds the same document
+        doc_id = user_timezones.user_day_doc_id(firestore_client, uid, event_dt)
         doc_ref = firestore_client.collection('raw_memories').document(doc_id)
 
         # Prepare the memory object WITHOUT server timestamp inside
@@ -87,17 +110,35 @@ async def save_to_firestore_background(uid: str, memory_data: dict):
         # Set a separate field 'last_webhook_update' using SERVER_TIMESTAMP
         update_data = {
             "memories": firestore.ArrayUnion([memory_entry_data]),
-            "last_webhook_update": firestore.SERVER_TIMESTAMP # Set timestamp on the main document
+            "last_webhook_update": firestore.SERVER_TIMESTAMP, # Set timestamp on the main document
+            # Lets the processor's cold-storage compaction query only days it hasn't compacted yet
+            "date": doc_id.rsplit("_", 1)[1],
+            "compaction_pending": True,
         }
         doc_ref.set(update_data, merge=True) # merge=True creates doc/fields if they don't exist
 
         logging.info(f"Successfully updated Firestore doc: {doc_id} for memory {memory_entry_data['memory_id']}")
 
+        # --- Geo Index ---
+        # Separate from the main write: a failure here must not lose the memory itself
+        try:
+            if geo_index.index_memory(firestore_client, uid, doc_id, memory_entry_data):
+                logging.info(f"Indexed geolocation for memory {memory_entry_data['memory_id']}")
+        except Exception as e:
+            logging.error(f"Failed to index geolocation for memory {memory_entry_data['memory_id']}: {e}")
+
     except GoogleAPICallError as e:
         logging.error(f"Firestore API error saving data for UID {uid}, Memory ID {memory_data.get('memory_id')}: {e}")
     except Exception as e:
         logging.error(f"Unexpected error saving data for UID {uid}, Memory ID {memory_data.get('memory_id')}: {e}")
 
+async def tracked_save_to_firestore(uid: str, memory_data: dict):
+    """Runs the save while counting it as in-flight work for admission control."""
+    try:
+        await save_to_firestore_background(uid, memory_data)
+    finally:
+        admission.task_finished()
+
 # --- Webhook Endpoint ---
 print("DEBUG: Defining endpoint @app.post('/memory_webhook')") # <<< ADD THIS LINE
 
@@ -105,12 +146,24 @@ print("DEBUG: Defining endpoint @app.post('/memory_webhook')") # <<< ADD THIS LI
 async def memory_webhook_receiver(request: Request, background_tasks: BackgroundTasks, uid: str):
     """Receives memory creation webhook, extracts data, and queues Firestore save."""
     logging.info(f"--- Memory Webhook Received for UID: {uid} ---")
+
+    # Reject before reading the body, so rejected requests cost next to nothing
+    reason, retry_after = admission.admit(uid)
+    if reason:
+        logging.warning(f"Rejecting webhook for UID {uid} ({reason}), Retry-After {retry_after}s")
+        raise HTTPException(status_code=429, detail=f"Too many requests ({reason})", headers={"Retry-After": str(retry_after)})
+
     try:
-        payload = await request.json()
+        body = await admission_control.read_body_limited(request)
+        payload = json.loads(body)
         logging.info(f"Received payload keys: {list(payload.keys())}")
         # You might want to log the payload structure initially for debugging:
         logging.debug(json.dumps(payload, indent=2))
 
+    except admission_control.PayloadTooLarge:
+        admission.rejected["payload_too_large"] += 1
+        logging.warning(f"Payload for UID {uid} exceeds {admission_control.MAX_PAYLOAD_BYTES} bytes")
+        raise HTTPException(status_code=413, detail="Payload too large")
     except Exception as e:
          logging.error(f"Error reading request body: {e}")
          raise HTTPException(status_code=400, detail="Could not read request body")
@@ -146,7 +199,8 @@ async def memory_webhook_receiver(request: Request, background_tasks: Background
 
     # Add the Firestore saving task to run in the background
     # This allows us to return a response to Omi quickly
-    background_tasks.add_task(save_to_firestore_background, uid, memory_data_to_save)
+    admission.task_started()
+    background_tasks.add_task(tracked_save_to_firestore, uid, memory_data_to_save)
 
     logging.info(f"Queued memory {memory_id} for Firestore save. Returning 200 OK to Omi.")
     # Return a simple success message immediately
@@ -170,9 +224,10 @@ async def get_daily_reflection(uid: str, date: str | None = None):
         # Optional: Add validation for YYYY-MM-DD format here if desired
         target_date_str = date
     else:
-        # Default to today's date in UTC
-        target_date_str = datetime.now(timezone.utc).strftime('%Y-%m-%d')
-        logging.info(f"No date provided, defaulting to today: {target_date_str}")
+        # Default to today's date in the user's registered timezone
+        tz_name = user_timezones.get_user_timezone_name(firestore_client, uid)
+        target_date_str = user_timezones.local_date_str(datetime.now(timezone.utc), tz_name)
+        logging.info(f"No date provided, defaulting to today ({tz_name}): {target_date_str}")
 
     doc_id = f"{uid}_{target_date_str}"
     logging.info(f"Attempting to fetch reflection data from Firestore doc: {doc_id}")
@@ -198,6 +253,239 @@ async def get_daily_reflection(uid: str, date: str | None = None):
         logging.error(f"Unexpected error reading daily_reflections for {doc_id}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+# --- Endpoint to Register a User's Timezone ---
+@app.post("/user_timezone")
+async def register_user_timezone(uid: str, timezone_name: str):
+    """
+    Registers the IANA timezone (e.g. 'Asia/Manila') used to bucket a user's memories
+    into {uid}_{YYYY-MM-DD} documents and to schedule their end-of-day processing.
+    """
+    logging.info(f"--- POST /user_timezone request for UID: {uid}, Timezone: {timezone_name} ---")
+
+    if not user_timezones.is_valid_timezone(timezone_name):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone '{timezone_name}'")
+
+    if not firestore_available:
+        logging.error("Firestore client not available for user_timezone.")
+        raise HTTPException(status_code=500, detail="Database connection error")
+
+    try:
+        user_timezones.set_user_timezone(firestore_client, uid, timezone_name)
+        logging.info(f"Registered timezone {timezone_name} for UID {uid}")
+        return {"uid": uid, "timezone": timezone_name}
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error writing user_settings for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database write error")
+
+# --- Push Channel: Reflection Ready Events (SSE) ---
+@app.get("/reflections/stream")
+async def stream_reflection_events(request: Request, uid: str):
+    """
+    Server-Sent Events channel per uid. Emits a `reflection_ready` event ({uid, date, prompt_version})
+    whenever the processor writes one of the user's reflections, so clients don't poll /get_reflection.
+    After a reconnect, clients should catch up via /reflections/changes.
+    """
+    logging.info(f"--- SSE subscribe for UID: {uid} ---")
+    try:
+        queue = pubsub.subscribe(uid)
+    except reflection_pubsub.TooManySubscribers:
+        raise HTTPException(status_code=429, detail="Too many open streams for this user", headers={"Retry-After": "30"})
+
+    async def event_stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n" # Keeps proxies from closing an idle stream
+                    continue
+                yield f"event: {event.get('type', 'reflection_ready')}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            pubsub.unsubscribe(uid, queue)
+            logging.info(f"--- SSE unsubscribe for UID: {uid} ---")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _format_cursor(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+@app.post("/reflections/publish")
+async def publish_reflection_event(event: dict):
+    """Publish hook for PUBSUB_BACKEND=memory (local testing): the processor POSTs its events here."""
+    if reflection_pubsub.PUBSUB_BACKEND != "memory":
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not event.get("uid"):
+        raise HTTPException(status_code=400, detail="Missing uid")
+    pubsub.publish(event)
+    return {"status": "published"}
+
+
+@app.get("/reflections/changes")
+async def get_reflection_changes(uid: str, since: str | None = None, limit: int = 50):
+    """
+    Reflections for a user written/updated after the `since` cursor (oldest first).
+    Pass the returned `next_cursor` as `since` on the next call. Omit `since` for everything.
+    """
+    logging.info(f"--- GET /reflections/changes request for UID: {uid}, since: {since} ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    limit = max(1, min(limit, 200))
+
+    query = firestore_client.collection('daily_reflections').where("uid", "==", uid)
+    if since:
+        try:
+            since_dt = datetime.fromisoformat(since.replace('Z', '+00:00'))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where("processed_at", ">", since_dt)
+    query = query.order_by("processed_at").limit(limit)
+
+    try:
+        reflections = [{"doc_id": snap.id, **snap.to_dict()} for snap in query.stream()]
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error reading reflection changes for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database query error")
+
+    # Z-suffixed, so the cursor survives being put in a query string unencoded (a "+" would become a space)
+    next_cursor = _format_cursor(reflections[-1]["processed_at"]) if reflections else since
+    return {"uid": uid, "reflections": reflections, "next_cursor": next_cursor, "has_more": len(reflections) == limit}
+
+# --- Action Items (cross-day store maintained by the processor) ---
+ACTION_ITEM_STATUSES = ("open", "done")
+
+
+@app.get("/action_items")
+async def get_action_items(uid: str, status: str | None = "open", limit: int = 100):
+    """
+    The user's deduplicated action items (near-duplicates across days are merged by the
+    processor), most recently mentioned first. status: "open" (default), "done", or "all".
+    """
+    logging.info(f"--- GET /action_items request for UID: {uid}, status: {status} ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    if status not in ACTION_ITEM_STATUSES + ("all",):
+        raise HTTPException(status_code=400, detail="Invalid status")
+    limit = max(1, min(limit, 500))
+
+    query = firestore_client.collection('action_items').document(uid).collection('items')
+    if status != "all":
+        query = query.where("status", "==", status)
+    # Only the fields the client needs; signatures stay server-side
+    query = query.select(["text", "status", "first_seen", "last_seen", "occurrences", "done_on"]) \
+        .order_by("last_seen", direction=firestore.Query.DESCENDING).limit(limit)
+
+    try:
+        items = [{"item_id": snap.id, **snap.to_dict()} for snap in query.stream()]
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error reading action items for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database query error")
+    return {"uid": uid, "status": status, "action_items": items}
+
+
+@app.post("/action_items/{item_id}/status")
+async def set_action_item_status(item_id: str, uid: str, status: str):
+    """Marks an item done (or reopens it). A done item reopens if it's mentioned again on a later day."""
+    logging.info(f"--- POST /action_items/{item_id}/status for UID: {uid}, status: {status} ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    if status not in ACTION_ITEM_STATUSES:
+        raise HTTPException(status_code=400, detail="Invalid status")
+
+    item_ref = firestore_client.collection('action_items').document(uid).collection('items').document(item_id)
+    update = {"status": status, "updated_at": firestore.SERVER_TIMESTAMP}
+    # done_on is a local date, comparable with the item's mention dates
+    tz_name = user_timezones.get_user_timezone_name(firestore_client, uid)
+    update["done_on"] = user_timezones.local_date_str(datetime.now(timezone.utc), tz_name) if status == "done" else None
+    try:
+        item_ref.update(update)
+    except NotFound:
+        raise HTTPException(status_code=404, detail="Action item not found")
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error updating action item {item_id} for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database update error")
+    return {"item_id": item_id, "status": status, "done_on": update["done_on"]}
+
+# --- Geo Endpoints: Places and Location Queries ---
+def _local_day_bounds(uid: str, start: str | None, end: str | None, default_days: int):
+    """Converts inclusive local YYYY-MM-DD dates to a [start, end) UTC datetime range."""
+    tz = pytz.timezone(user_timezones.get_user_timezone_name(firestore_client, uid))
+    try:
+        end_date = datetime.strptime(end, '%Y-%m-%d').date() if end else datetime.now(tz).date()
+        start_date = datetime.strptime(start, '%Y-%m-%d').date() if start else end_date - timedelta(days=default_days - 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    start_dt = tz.localize(datetime.combine(start_date, datetime.min.time()))
+    end_dt = tz.localize(datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    return start_dt, end_dt
+
+
+@app.get("/places")
+async def get_places(uid: str, start: str | None = None, end: str | None = None, radius_m: float = geo_index.PLACE_RADIUS_M):
+    """
+    Clusters the user's memory locations between two local dates (default: last 30 days)
+    into named places with visit counts and talk time.
+    """
+    logging.info(f"--- GET /places request for UID: {uid}, {start} -> {end} ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    if not (0 < radius_m <= 50_000):
+        raise HTTPException(status_code=400, detail="radius_m must be in (0, 50000]")
+
+    start_dt, end_dt = _local_day_bounds(uid, start, end, default_days=30)
+    try:
+        points = await run_in_threadpool(geo_index.load_points_between, firestore_client, uid, start_dt, end_dt)
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error reading geo index for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database query error")
+
+    # Clustering is CPU-bound; keep it off the event loop /memory_webhook runs on
+    places = await run_in_threadpool(geo_index.cluster_places, points, radius_m)
+    return {"uid": uid, "point_count": len(points), "places": places}
+
+
+@app.get("/memories_near")
+async def get_memories_near(uid: str, lat: float, lng: float, radius_m: float = 200.0):
+    """Memories recorded within radius_m of a point, nearest first ("what did I talk about at the office")."""
+    logging.info(f"--- GET /memories_near request for UID: {uid}, ({lat}, {lng}) r={radius_m}m ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not (0 < radius_m <= 50_000):
+        raise HTTPException(status_code=400, detail="Invalid coordinates or radius (max 50km)")
+
+    try:
+        memories = await run_in_threadpool(geo_index.query_radius, firestore_client, uid, lat, lng, radius_m)
+        return {"uid": uid, "memories": memories}
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error querying geo index for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database query error")
+
+
+@app.get("/memories_in_bbox")
+async def get_memories_in_bbox(uid: str, min_lat: float, min_lng: float, max_lat: float, max_lng: float):
+    """Memories recorded inside a bounding box."""
+    logging.info(f"--- GET /memories_in_bbox request for UID: {uid} ---")
+    if not firestore_available:
+        raise HTTPException(status_code=500, detail="Database connection error")
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lng <= max_lng <= 180):
+        raise HTTPException(status_code=400, detail="Invalid bounding box")
+
+    try:
+        memories = await run_in_threadpool(geo_index.query_bbox, firestore_client, uid, min_lat, min_lng, max_lat, max_lng)
+        return {"uid": uid, "memories": memories}
+    except GoogleAPICallError as e:
+        logging.error(f"Firestore API error querying geo index for {uid}: {e}")
+        raise HTTPException(status_code=500, detail="Database query error")
+
+# --- Queue Depth for Autoscaling ---
+@app.get("/queue_depth")
+def get_queue_depth():
+    """In-flight background saves and admission counters for this server process."""
+    return {**admission.stats(), "sse_subscribers": pubsub.subscriber_count()}
+
 # --- Root Endpoint for Health Check ---
 @app.get("/")
 def read_root():
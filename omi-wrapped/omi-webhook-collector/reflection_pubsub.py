@@ -0,0 +1,109 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+# --- Reflection-Ready Pub/Sub for SSE Clients ---
+# Clients subscribe per uid (GET /reflections/stream) and get an event as soon as the processor
+# writes their reflection, instead of polling /get_reflection. Pluggable via PUBSUB_BACKEND:
+#   "firestore" (default): listen to the reflection_events collection the processor appends to,
+#                          and fan each event out to this instance's subscribers.
+#   "memory":              in-process only; the processor (PUBSUB_BACKEND=memory) POSTs events to
+#                          /reflections/publish. Local testing: run a single uvicorn worker, since
+#                          each worker has its own subscribers.
+
+EVENTS_COLLECTION = "reflection_events"
+PUBSUB_BACKEND = os.environ.get("PUBSUB_BACKEND", "firestore")
+MAX_SUBSCRIBERS_PER_UID = int(os.environ.get("SSE_MAX_SUBSCRIBERS_PER_UID", "5"))
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class InProcessPubSub:
+    """Fans events out to per-uid asyncio queues. publish() is safe to call from any thread."""
+
+    def __init__(self):
+        self._subscribers = {} # uid -> set of asyncio.Queue
+        self._loop = None
+
+    def start(self, loop, firestore_client=None):
+        self._loop = loop
+
+    def stop(self):
+        pass
+
+    def subscribe(self, uid: str) -> asyncio.Queue:
+        queues = self._subscribers.setdefault(uid, set())
+        if len(queues) >= MAX_SUBSCRIBERS_PER_UID:
+            raise TooManySubscribers()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        queues.add(queue)
+        return queue
+
+    def unsubscribe(self, uid: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(uid)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[uid]
+
+    def publish(self, event: dict):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        # Queues belong to the server's event loop; hop onto it when called from another thread
+        if self._loop is not None and running_loop is not self._loop:
+            self._loop.call_soon_threadsafe(self._deliver, event)
+        else:
+            self._deliver(event)
+
+    def _deliver(self, event: dict):
+        for queue in list(self._subscribers.get(event.get("uid"), ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A stuck client loses live events, it can catch up via /reflections/changes
+                logging.warning(f"Dropping event for slow SSE subscriber of UID {event.get('uid')}")
+
+    def subscriber_count(self) -> int:
+        return sum(len(q) for q in self._subscribers.values())
+
+
+class FirestorePubSub(InProcessPubSub):
+    """Listens to reflection_events (written by the processor) and delivers them locally."""
+
+    def __init__(self):
+        super().__init__()
+        self._watch = None
+
+    def start(self, loop, firestore_client=None):
+        super().start(loop)
+        if firestore_client is None:
+            logging.error("Firestore client unavailable, reflection events listener not started.")
+            return
+        started_at = datetime.now(timezone.utc)
+        query = firestore_client.collection(EVENTS_COLLECTION).where("created_at", ">=", started_at)
+        self._watch = query.on_snapshot(self._on_snapshot)
+        logging.info("Listening for reflection events.")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_snapshot(self, _docs, changes, _read_time):
+        # Runs on the Firestore listener thread
+        for change in changes:
+            if change.type.name == "ADDED":
+                event = change.document.to_dict() or {}
+                event.pop("created_at", None)
+                event.pop("expire_at", None)
+                self.publish(event)
+
+
+def create_pubsub():
+    return InProcessPubSub() if PUBSUB_BACKEND == "memory" else FirestorePubSub()
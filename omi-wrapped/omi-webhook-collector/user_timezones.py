@@ -0,0 +1,84 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+import pytz
+
+# --- Per-User Timezone Registry ---
+# Both services key documents as {uid}_{YYYY-MM-DD}. The date part MUST be the user's
+# *local* calendar date, so the collector (which writes raw_memories) and the
+# daily-reflection-processor (which reads them) resolve it the same way.
+# The registry lives in Firestore: user_settings/{uid} -> {"timezone": "Area/City", ...}
+
+USER_SETTINGS_COLLECTION = "user_settings"
+# Fallback keeps the historical behaviour (everything was bucketed for Pacific Time users)
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "America/Los_Angeles")
+# Cache lookups so we don't pay a Firestore read on every webhook
+CACHE_TTL_SECONDS = int(os.environ.get("TIMEZONE_CACHE_TTL_SECONDS", "600"))
+
+_timezone_cache = {}  # uid -> (timezone_name, expires_at, registered)
+
+
+def is_valid_timezone(tz_name: str) -> bool:
+    """Returns True if tz_name is a known IANA timezone name."""
+    return bool(tz_name) and tz_name in pytz.all_timezones_set
+
+
+def get_user_timezone_name(firestore_client, uid: str, register: bool = False) -> str:
+    """
+    Looks up the user's registered timezone, falling back to DEFAULT_TIMEZONE.
+    register=True (webhook save path only) creates user_settings/{uid} for a first-time user.
+    Read-only endpoints must not, or any request with an arbitrary uid would add a user the
+    end-of-day scheduler scans forever.
+    """
+    cached = _timezone_cache.get(uid)
+    if cached and cached[1] > time.monotonic() and (cached[2] or not register):
+        return cached[0]
+
+    tz_name = DEFAULT_TIMEZONE
+    registered = False
+    if firestore_client is not None:
+        try:
+            snapshot = firestore_client.collection(USER_SETTINGS_COLLECTION).document(uid).get()
+            if snapshot.exists:
+                registered = True
+                registered_tz = (snapshot.to_dict() or {}).get("timezone")
+                if is_valid_timezone(registered_tz):
+                    tz_name = registered_tz
+                elif registered_tz:
+                    logging.warning(f"Ignoring invalid timezone '{registered_tz}' registered for UID {uid}.")
+            elif register:
+                # First time we see this user: register them with the default timezone so the
+                # end-of-day scheduler (which iterates user_settings) picks them up
+                snapshot.reference.set({"timezone": tz_name}, merge=True)
+                registered = True
+                logging.info(f"Registered new UID {uid} with default timezone {tz_name}.")
+        except Exception as e:
+            # Don't cache failures, try again on the next request
+            logging.error(f"Error reading timezone for UID {uid}: {e}. Using default {DEFAULT_TIMEZONE}.")
+            return tz_name
+
+    _timezone_cache[uid] = (tz_name, time.monotonic() + CACHE_TTL_SECONDS, registered)
+    return tz_name
+
+
+def set_user_timezone(firestore_client, uid: str, tz_name: str):
+    """Registers (or updates) the user's timezone. Caller must validate tz_name first."""
+    firestore_client.collection(USER_SETTINGS_COLLECTION).document(uid).set(
+        {"timezone": tz_name}, merge=True
+    )
+    _timezone_cache[uid] = (tz_name, time.monotonic() + CACHE_TTL_SECONDS, True)
+
+
+def local_date_str(event_dt: datetime, tz_name: str) -> str:
+    """Converts an aware (or naive UTC) datetime to the YYYY-MM-DD date in tz_name."""
+    if event_dt.tzinfo is None:
+        event_dt = event_dt.replace(tzinfo=timezone.utc)
+    return event_dt.astimezone(pytz.timezone(tz_name)).strftime('%Y-%m-%d')
+
+
+def user_day_doc_id(firestore_client, uid: str, event_dt: datetime) -> str:
+    """Builds the {uid}_{YYYY-MM-DD} document ID for an event, using the user's local date.
+    Used by the webhook save path, so first-time users get registered here."""
+    tz_name = get_user_timezone_name(firestore_client, uid, register=True)
+    return f"{uid}_{local_date_str(event_dt, tz_name)}"
@@ -5,6 +5,11 @@ console.log("Omi Wrapped Frontend Script Loaded!");
 // Make sure to include the /get_reflection path!
 const API_ENDPOINT = 'https://omi-to-notion-363551469917.us-west2.run.app/get_reflection'; // <<< REPLACE THIS LATER
 const USER_ID = 'ckVQW3MVAoenlOdYhHLt5K3zPpW2'; // <<< REPLACE with your user ID for testing
+// Server-Sent Events channel: the backend pushes "reflection_ready" when the nightly job finishes
+const EVENTS_ENDPOINT = API_ENDPOINT.replace('/get_reflection', '/reflections/stream');
+
+// Open push subscription (only one at a time)
+let reflectionEventSource = null;
 
 // Global swiper instance
 let swiperInstance;
@@ -240,6 +245,9 @@ async function loadReflectionData(customDate = null) {
     const swiperContainer = document.getElementById('reflection-swiper');
     const swiperWrapper = document.getElementById('swiper-wrapper-main');
 
+    // Stop waiting on a previously requested day
+    stopWaitingForReflection();
+
     // Clear previous slides
     swiperWrapper.innerHTML = '';
     loadingIndicator.textContent = 'Fetching your reflection... 🧠'; // Update loading text
@@ -272,8 +280,20 @@ async function loadReflectionData(customDate = null) {
     try {
         const response = await fetch(url);
 
+        if (response.status === 404) {
+            if (isStillProcessable(dateStr)) {
+                // Not processed yet: wait for the push event instead of polling
+                loadingIndicator.textContent = 'Your reflection is still being prepared... we\'ll show it as soon as it\'s ready ⏳';
+                waitForReflection(dateStr);
+            } else {
+                // Older days without a reflection had no memories, nothing will arrive
+                loadingIndicator.textContent = 'No reflection for this day (no memories were recorded).';
+            }
+            return;
+        }
+
         if (!response.ok) {
-            // Handle HTTP errors (like 404 Not Found, 500 Internal Server Error)
+            // Handle HTTP errors (like 500 Internal Server Error)
             const errorText = await response.text();
             console.error(`API Error ${response.status}: ${errorText}`);
             loadingIndicator.textContent = `Error: Could not load reflection (${response.status}). Try again later.`;
@@ -386,6 +406,57 @@ async function loadReflectionData(customDate = null) {
     }
 }
 
+// Only today and yesterday (local time) can still get a reflection from the nightly job
+function isStillProcessable(dateStr) {
+    const today = new Date();
+    const yesterday = new Date(today);
+    yesterday.setDate(today.getDate() - 1);
+    return dateStr === formatDateForAPI(today) || dateStr === formatDateForAPI(yesterday);
+}
+
+// Subscribe to reflection-ready events and reload once the given date is processed
+function waitForReflection(dateStr) {
+    stopWaitingForReflection();
+    if (!window.EventSource) {
+        console.warn('EventSource not supported, not waiting for push updates.');
+        return;
+    }
+
+    const url = new URL(EVENTS_ENDPOINT);
+    url.searchParams.append('uid', USER_ID);
+    reflectionEventSource = new EventSource(url);
+    console.log(`Waiting for reflection_ready on ${url}`);
+
+    reflectionEventSource.addEventListener('reflection_ready', (event) => {
+        const data = JSON.parse(event.data);
+        console.log('Received reflection_ready event:', data);
+        if (data.date === dateStr) {
+            stopWaitingForReflection();
+            loadReflectionData(dateStr);
+        }
+    });
+    // Events sent while we weren't connected are missed, so check once on every (re)connect
+    reflectionEventSource.onopen = async () => {
+        const checkUrl = new URL(API_ENDPOINT);
+        checkUrl.searchParams.append('uid', USER_ID);
+        checkUrl.searchParams.append('date', dateStr);
+        const response = await fetch(checkUrl);
+        if (response.ok && reflectionEventSource) {
+            stopWaitingForReflection();
+            loadReflectionData(dateStr);
+        }
+    };
+    // EventSource reconnects on its own after errors (server sends retry: 5000)
+    reflectionEventSource.onerror = () => console.warn('Reflection event stream interrupted, reconnecting...');
+}
+
+function stopWaitingForReflection() {
+    if (reflectionEventSource) {
+        reflectionEventSource.close();
+        reflectionEventSource = null;
+    }
+}
+
 // Setup back button functionality
 function setupBackButton() {
     const backButton = document.getElementById('back-button');